@@ -10,13 +10,47 @@
 # included in all copies or substantial portions of the Software.
 
 
+import array
+import collections
+import concurrent.futures
+import cProfile
+import functools
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import random
 import re
+import sqlite3
+import struct
+import sys
+import time
 import unicodedata
 import beets
-from beets import config
+from beets import config, logging, plugins
 from beets.dbcore import types
+from beets.dbcore.query import AndQuery, MatchQuery, NumericQuery, OrQuery
+from beets.library import (
+    Album,
+    FileOperationError,
+    Item,
+    ReadError,
+    WriteError,
+    parse_query_parts,
+)
 from beets.ui import decargs, print_, should_write
 from beets.plugins import BeetsPlugin
+from beets.util import syspath
+from mediafile import MediaFile, UnreadableFileError
+
+try:
+    from beets.importer import Action
+except ImportError:  # beets < 2.3
+    from beets.importer import action as Action
+
+# The same logger as the plugin's _log, for the code outside of the plugin class
+log = logging.getLogger("beets.autoartists")
 
 
 class AutoArtistsPlugin(BeetsPlugin):
@@ -28,6 +62,21 @@ class AutoArtistsPlugin(BeetsPlugin):
                 "overwrite": True,
                 "separators": ["␟", ", ", " & ", " and ", " + ", " with ", "/", ";"],
                 "single_artists": [],
+                "single_artists_file": None,
+                "feat_keywords": ["feat.", "featuring", "with"],
+                "normalize_cache_size": 4096,
+                "cache": False,
+                "cache_path": None,
+                "cache_size": 1000000,
+                "chunk_size": 1000,
+                "db_batch_size": 100,
+                "write_workers": 0,
+                "jobs": 0,
+                "write_artists_only": False,
+                "library_artists": False,
+                "auto_update": False,
+                "stats": False,
+                "shadow_fraction": 0.0,
             }
         )
         self.item_types = {}
@@ -36,6 +85,57 @@ class AutoArtistsPlugin(BeetsPlugin):
         self.overwrite = self.config["overwrite"]
         self.single_artist_list = [x.as_str() for x in self.config["single_artists"]]
         self.separators = [x.as_str() for x in self.config["separators"]]
+        self.feat_keywords = [x.as_str() for x in self.config["feat_keywords"]]
+        self.single_artists_file = None
+        if self.config["single_artists_file"].get():
+            self.single_artists_file = self.config["single_artists_file"].as_filename()
+            if not os.path.isfile(self.single_artists_file):
+                self._log.error(
+                    f"single_artists_file {self.single_artists_file} not found"
+                )
+                self.single_artists_file = None
+        self.parser = ArtistParser(
+            self.single_artist_list,
+            self.separators,
+            self.feat_keywords,
+            self.single_artists_file,
+        )
+        set_normalize_cache_size(self.config["normalize_cache_size"].get(int))
+        self.parse_cache = None
+        self.parse_pool = None
+        self.parse_jobs = 0
+        self.write_pool = None
+        self.write_failures = []
+        # The StageStats of a run with --stats (or an import with stats), else None
+        self.stats = None
+        if self.config["stats"]:
+            self.register_listener("import", self.import_stats)
+        # With shadow_fraction, that fraction of the parsed items is also parsed by
+        # the ReferenceArtistParser and the results are compared
+        self.shadow_fraction = self.config["shadow_fraction"].as_number()
+        self.reference_parser = None
+        self.shadow_random = random.Random()
+        self.shadow_checked = 0
+        self.shadow_diverged = 0
+        # Ids of the items changed by the beet command (not by this plugin), whose
+        # artists are derived again when it exits with auto_update
+        self.changed_item_ids = set()
+        self.storing_changes = False
+        if self.config["auto_update"]:
+            self.register_listener("database_change", self.item_changed)
+            self.register_listener("cli_exit", self.update_changed_items)
+        # After update_changed_items, which may parse items too
+        if self.shadow_fraction > 0:
+            self.register_listener("cli_exit", self.report_shadow)
+        # Ids of the items whose artists may have changed since the library artist
+        # index was updated, see flush_library_artists
+        self.library_artists_dirty = set()
+        self.library_artists_loaded = False
+        if self.config["library_artists"]:
+            self.register_listener("item_imported", self.library_item_imported)
+            self.register_listener("database_change", self.library_changed)
+            self.register_listener("item_removed", self.library_item_removed)
+            self.register_listener("cli_exit", self.flush_library_artists)
         if self.config["auto"]:
             self.import_stages = [self.imported]
         self._log.debug(f"Single artist list: {self.single_artist_list}")
@@ -56,6 +156,114 @@ class AutoArtistsPlugin(BeetsPlugin):
             default=False,
             help="Overwrite if artists field is already present (overrule config file overwrite: False)",
         )
+        autoartists.parser.add_option(
+            "-a",
+            "--album",
+            dest="album",
+            action="store_true",
+            default=False,
+            help="Process the tracks of the albums matching the query, album by album",
+        )
+        autoartists.parser.add_option(
+            "-y",
+            "--yes",
+            dest="yes",
+            action="store_true",
+            default=False,
+            help="Apply the changes without asking for confirmation",
+        )
+        autoartists.parser.add_option(
+            "--since-last-run",
+            dest="since_last_run",
+            action="store_true",
+            default=False,
+            help="Only process items added or modified since the last run with the same query",
+        )
+        autoartists.parser.add_option(
+            "--list-unchanged",
+            dest="list_unchanged",
+            action="store_true",
+            default=False,
+            help="List the items whose artists would not change",
+        )
+        autoartists.parser.add_option(
+            "--write-workers",
+            dest="write_workers",
+            type="int",
+            default=None,
+            help="Number of threads writing tags to files (overrule config file write_workers)",
+        )
+        autoartists.parser.add_option(
+            "-j",
+            "--jobs",
+            dest="jobs",
+            type="int",
+            default=None,
+            help="Number of processes parsing artists (overrule config file jobs)",
+        )
+        autoartists.parser.add_option(
+            "--plan",
+            dest="plan",
+            metavar="FILE",
+            default=None,
+            help="Write the changes to FILE (JSON lines) instead of applying them",
+        )
+        autoartists.parser.add_option(
+            "--apply",
+            dest="apply_plan",
+            metavar="FILE",
+            default=None,
+            help="Apply the changes from a --plan FILE, skipping items edited since",
+        )
+        autoartists.parser.add_option(
+            "--shard",
+            dest="shard",
+            metavar="K/N",
+            default=None,
+            help="Only process the items whose id % N is K - 1 (with --plan FILE)",
+        )
+        autoartists.parser.add_option(
+            "--write-files",
+            dest="write_files",
+            action="store_true",
+            default=False,
+            help="With --plan, write the tags to the files (the library is updated by --apply/--merge)",
+        )
+        autoartists.parser.add_option(
+            "--merge",
+            dest="merge",
+            action="store_true",
+            default=False,
+            help="Apply the --plan FILEs given as arguments (e.g. of each --shard)",
+        )
+        autoartists.parser.add_option(
+            "--rebuild-index",
+            dest="rebuild_index",
+            action="store_true",
+            default=False,
+            help="Rebuild the index of the artist names in the library (library_artists) and exit",
+        )
+        autoartists.parser.add_option(
+            "--verify-engine",
+            dest="verify_engine",
+            action="store_true",
+            default=False,
+            help="Compare the parser with the reference parser on the items in the query and exit",
+        )
+        autoartists.parser.add_option(
+            "--stats",
+            dest="stats",
+            action="store_true",
+            default=False,
+            help="Print the time spent in each stage of the run",
+        )
+        autoartists.parser.add_option(
+            "--profile",
+            dest="profile",
+            metavar="FILE",
+            default=None,
+            help="Write cProfile stats of the run to FILE",
+        )
         autoartists.func = self.exec_autoartists
         return [autoartists]
 
@@ -67,69 +275,231 @@ class AutoArtistsPlugin(BeetsPlugin):
             self.overwrite = True
         elif opts.dontoverwrite:
             self.overwrite = False
+        if opts.plan and opts.apply_plan:
+            self._log.error("Can't specify --plan and --apply")
+            exit(1)
+        if opts.merge and (opts.plan or opts.apply_plan):
+            self._log.error("Can't specify --merge with --plan or --apply")
+            exit(1)
+        if opts.merge and not args:
+            self._log.error("--merge needs the plan FILEs to apply")
+            exit(1)
+        if opts.shard:
+            opts.shard = parse_shard(opts.shard)
+            if opts.shard is None:
+                self._log.error("--shard must be K/N, with 1 <= K <= N")
+                exit(1)
+            if not opts.plan or opts.album:
+                self._log.error("--shard needs --plan FILE, and can't be used with -a")
+                exit(1)
+            if opts.since_last_run:
+                # Each shard would record its own last run for the whole query
+                self._log.error("Can't specify --shard and --since-last-run")
+                exit(1)
+        if opts.write_files and not opts.plan:
+            self._log.error("--write-files needs --plan FILE")
+            exit(1)
+        if opts.rebuild_index:
+            self.rebuild_library_artists(lib)
+            return
+        profiler = None
+        if opts.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.load_library_artists(lib)
         # options override config settings:
-        query_result_songs = lib.items(decargs(args))
-        # choices is a list of tuples of (song, artists list) for each match in the query
-        choices = []
-        if not self.overwrite:
-            query_result_songs = [
-                x
-                for x in query_result_songs
-                if "artists" not in x or len(x["artists"]) < 1
-            ]
-        for song in query_result_songs:
-            artist = str(song["artist"])
-            title = str(song["title"])
-            artists = None if "artists" not in song else song["artists"]
-            artists_result = self.get_artists(
-                artist=artist, title=title, artists=artists
+        if self.config["cache"]:
+            self.open_parse_cache(lib)
+        if opts.stats or self.config["stats"]:
+            self.start_stats()
+        write_workers = opts.write_workers
+        if write_workers is None:
+            write_workers = self.config["write_workers"].get(int)
+        if write_workers > 0:
+            self.write_pool = concurrent.futures.ThreadPoolExecutor(write_workers)
+        self.parse_jobs = opts.jobs
+        if self.parse_jobs is None:
+            self.parse_jobs = self.config["jobs"].get(int)
+        if self.parse_jobs > 0:
+            self.parse_pool = concurrent.futures.ProcessPoolExecutor(
+                self.parse_jobs,
+                initializer=init_parse_worker,
+                initargs=(self.parser,),
             )
-            choices.append((song, artists_result))
-
-        old_choices_len = len(choices)
-        new_choices = [
-            choice
-            for choice in choices
-            if "artists" not in choice[0]
-            or not lists_have_same_strings(choice[0]["artists"], choice[1])
-        ]
-        unchanged_choices = [choice for choice in choices if choice not in new_choices]
-        choices = new_choices
+        try:
+            if opts.verify_engine:
+                self.verify_engine(lib, args)
+            elif opts.apply_plan:
+                self.apply_plan(lib, opts.apply_plan)
+            elif opts.merge:
+                for path in args:
+                    self.apply_plan(lib, path)
+            else:
+                self.run_autoartists(lib, opts, args)
+        finally:
+            self.close_parse_cache()
+            if self.parse_pool is not None:
+                self.parse_pool.shutdown()
+                self.parse_pool = None
+            if self.write_pool is not None:
+                self.write_pool.shutdown()
+                self.write_pool = None
+            if self.stats is not None:
+                print_("Stats:")
+                for line in self.stop_stats():
+                    print_(line)
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(opts.profile)
+
+    # Starts timing the stages of the run, by wrapping the functions that do them
+    # (see StageStats)
+    def start_stats(self):
+        self.stats = StageStats()
+        module = sys.modules[__name__]
+        self.stats.instrument(self.parser, "get_artists", "get_artists")
+        self.stats.instrument(self.parser, "get_artists_many", "get_artists")
+        matcher = self.parser.single_artist_matcher
+        self.stats.instrument(matcher, "find", "whitelist matching")
+        extractor = self.parser.feat_extractor
+        self.stats.instrument(extractor, "extract_artist", "feat extraction")
+        self.stats.instrument(extractor, "extract_title", "feat extraction")
+        splitter = self.parser.separator_splitter
+        self.stats.instrument(splitter, "split", "separator splitting")
+        self.stats.instrument(module, "normalize_string", "normalization")
+        if self.parse_cache is not None:
+            self.stats.instrument(self.parse_cache, "get", "parse cache")
+            self.stats.instrument(self.parse_cache, "put", "parse cache")
+        self.stats.instrument(self, "finish_parse", "parse results")
+        self.stats.instrument(Item, "store", "store")
+        self.stats.instrument(module, "write_song", "write")
+
+    # Stops timing and returns the summary lines
+    def stop_stats(self):
+        stats = self.stats
+        self.stats = None
+        stats.uninstrument()
+        return stats.summary()
+
+    def import_stats(self, lib, paths):
+        if self.stats is not None:
+            for line in self.stop_stats():
+                self._log.info(f"Stats: {line}")
+
+    def run_autoartists(self, lib, opts, args):
+        run_started = time.time()
+        args = decargs(args)
+        last_run_key = "last_run " + ("-a " if opts.album else "") + " ".join(args)
+        query, sort = parse_query_parts(args, Album if opts.album else Item)
+        since_query = None
+        if opts.since_last_run:
+            last_run = read_state(self.state_path(lib), last_run_key)
+            if last_run is None:
+                print_("No previous run with this query, processing all items")
+            else:
+                since_query = changed_since_query(float(last_run))
+        if opts.album:
+            query_results = self.parse_albums(lib, query, sort, since_query)
+        else:
+            if since_query is not None:
+                query = AndQuery([query, since_query])
+            query_results = self.parse_query(
+                lib, query, sort, opts.shard, sorted_query=bool(query_sort_parts(args))
+            )
+        # changes is a list of ArtistsChange for each item in the query whose
+        # artists would change, the other items are only counted
+        # With --plan the changes are written to the plan file instead, and with
+        # --write-files to the files too, db_batch_size at a time (plan_changes)
+        # With auto_update, the sources of the unchanged items are recorded as the
+        # scan goes (unchanged_sources), see update_changed_items
+        changes = []
+        plan_changes = []
+        unchanged_sources = []
+        db_batch_size = self.config["db_batch_size"].get(int)
+        changes_count = 0
+        found = 0
+        plan_file = None
+        if opts.plan:
+            plan_file = open(opts.plan, "w", encoding="utf-8")
+            # The progress of applying a previous plan in this file doesn't apply to
+            # the new one
+            if os.path.exists(f"{opts.plan}.progress"):
+                os.remove(f"{opts.plan}.progress")
+        if opts.list_unchanged:
+            print_("Unchanged:")
+        try:
+            for song, artists_result in query_results:
+                found += 1
+                artists = None if "artists" not in song else song["artists"]
+                if artists is not None and lists_have_same_strings(
+                    artists, artists_result
+                ):
+                    if opts.list_unchanged:
+                        print_(f"{describe_song(lib, song)}: {artists}")
+                    if self.config["auto_update"] and plan_file is None:
+                        unchanged_sources.append((song["id"], artists_source(song)))
+                        if len(unchanged_sources) >= db_batch_size:
+                            self.record_sources(lib, unchanged_sources)
+                            unchanged_sources = []
+                    continue
+                changes_count += 1
+                if plan_file is None:
+                    changes.append(
+                        ArtistsChange(
+                            song["id"],
+                            f"{describe_song(lib, song)}",
+                            artists or [],
+                            artists_result,
+                            song.get("album_id") if opts.album else None,
+                        )
+                    )
+                elif opts.write_files:
+                    plan_changes.append((song, artists_result))
+                    if len(plan_changes) >= db_batch_size:
+                        self.write_plan_changes(lib, plan_file, plan_changes)
+                        plan_changes = []
+                else:
+                    plan_file.write(plan_record(song, artists_result) + "\n")
+            if plan_changes:
+                self.write_plan_changes(lib, plan_file, plan_changes)
+            self.record_sources(lib, unchanged_sources)
+        finally:
+            if plan_file is not None:
+                plan_file.close()
+
+        if plan_file is not None:
+            print_(
+                f"{found} found in query, {changes_count} changes written to {opts.plan}"
+            )
+            self.report_write_failures()
+            # The plan covers the items changed until now, --apply applies it later
+            write_state(self.state_path(lib), last_run_key, str(run_started))
+            return
         overwrite_message = ""
         if not self.overwrite:
             overwrite_message = " that would not be overwritten"
         print_(
-            f"{old_choices_len} found in query{overwrite_message}, {old_choices_len - len(choices)} had no changes"
+            f"{found} found in query{overwrite_message}, {found - changes_count} had no changes"
         )
-        if len(choices) == 0:
-            if old_choices_len > 0:
+        if len(changes) == 0:
+            if found > 0:
                 print_("Nothing to change")
             else:
                 print_("No results found")
+            write_state(self.state_path(lib), last_run_key, str(run_started))
             exit()
-        if len(unchanged_choices) > 0:
-            print_("Unchanged:")
-        for choice in unchanged_choices:
-            song = choice[0]
-            final_list = choice[1]
-            artists = []
-            if "artists" in song:
-                artists = song["artists"]
-            print_(f"{song}: {artists}")
         print_("---")
         print_("Changes:")
-        for choice in choices:
-            song = choice[0]
-            final_list = choice[1]
-            artists = []
-            if "artists" in song:
-                artists = song["artists"]
-            print_(f"{song}: ")
-            print_(f"old: {artists} => new: {final_list}")
-
-        confirm = input(
-            f"Changing {len(choices)} items. Confirm? (yes/no/select)\n"
-        ).lower()
+        for change in changes:
+            print_(f"{change.description}: ")
+            print_(f"old: {change.old} => new: {change.new}")
+
+        if opts.yes:
+            confirm = "yes"
+        else:
+            confirm = input(
+                f"Changing {len(changes)} items. Confirm? (yes/no/select)\n"
+            ).lower()
         if confirm in ["y", "yes"]:
             keep_asking = False
             confirm_item = ""
@@ -139,40 +509,728 @@ class AutoArtistsPlugin(BeetsPlugin):
         else:
             print_("canceled")
             exit()
-        for choice in choices:
-            song = choice[0]
-            final_list = choice[1]
-            artists = [""]
-            if "artists" in song:
-                artists = song["artists"]
+        confirmed_changes = self.confirmed_changes(changes, keep_asking)
+        if opts.album:
+            # The changes of each album are stored and written together
+            batches = (
+                list(album_changes)
+                for _, album_changes in itertools.groupby(
+                    confirmed_changes, key=lambda x: x.album_id
+                )
+            )
+        else:
+            batches = batched(confirmed_changes, self.config["db_batch_size"].get(int))
+        for batch in batches:
+            self.apply_changes(lib, [(lib.get_item(x.id), x.new) for x in batch])
+        self.report_write_failures()
+        write_state(self.state_path(lib), last_run_key, str(run_started))
+
+    # Yields (song, new artists) for each song in the query whose artists may be
+    # overwritten, reading and parsing chunk_size songs at a time
+    # When the query can be done in SQL, the songs are just the fields the plugin
+    # needs (see select_item_rows) and SQLite skips the songs that already have
+    # artists when they can't be overwritten. Otherwise they are Items.
+    # With shard (K, N) only the items whose id % N is K - 1 are parsed.
+    # With sorted_query (the query has a sort, like "year-") the songs are Items in
+    # that order, from one lib.items() query.
+    def parse_query(self, lib, query, sort, shard=None, sorted_query=False):
+        chunk_size = self.config["chunk_size"].get(int)
+        query_result_songs = None
+        if not sorted_query:
+            query_result_songs = select_item_rows(
+                lib,
+                query,
+                chunk_size,
+                empty_artists_only=not self.overwrite,
+                shard=shard,
+                fields=ITEM_ROW_FIELDS + display_fields(),
+            )
+        if query_result_songs is None:
+            if sorted_query:
+                songs = lib.items(query, sort)
+            else:
+                songs = iter_items_chunked(lib, query, sort, chunk_size)
+            query_result_songs = (
+                song
+                for song in songs
+                if (self.overwrite or "artists" not in song or len(song["artists"]) < 1)
+                and (shard is None or song.id % shard[1] == shard[0] - 1)
+            )
+        if self.stats is not None:
+            query_result_songs = self.stats.timed_iter("db loading", query_result_songs)
+        for songs, artists_results in self.parse_chunks(
+            batched(query_result_songs, chunk_size)
+        ):
+            yield from zip(songs, artists_results)
+
+    # Writes the (song, artists) changes to their files and to plan_file, with the
+    # new mtime of the files that were written, so --apply/--merge only stores them
+    def write_plan_changes(self, lib, plan_file, changes):
+        songs = [lib.get_item(song["id"]) for song, artists in changes]
+        for song, (row, artists) in zip(songs, changes):
+            song["artists"] = artists
+        errors = self.write_songs(songs)
+        for song, (row, artists), error in zip(songs, changes, errors):
+            mtime = song.mtime if error is None else None
+            plan_file.write(plan_record(row, artists, mtime) + "\n")
+
+    # parse_query for the tracks of the albums matching query (and item_query, if
+    # given), album by album. The parsed chunks hold whole albums, so the artist
+    # string the tracks of an album share is parsed once for the album.
+    def parse_albums(self, lib, query, sort, item_query=None):
+        def album_songs():
+            for album in lib.albums(query, sort):
+                if item_query is None:
+                    songs = album.items()
+                else:
+                    songs = lib.items(
+                        AndQuery([MatchQuery("album_id", album.id), item_query])
+                    )
+                songs = [
+                    song
+                    for song in songs
+                    if self.overwrite
+                    or "artists" not in song
+                    or len(song["artists"]) < 1
+                ]
+                if songs:
+                    yield songs
+
+        album_songs = album_songs()
+        if self.stats is not None:
+            album_songs = self.stats.timed_iter("db loading", album_songs)
+        chunks = batched_groups(album_songs, self.config["chunk_size"].get(int))
+        for songs, artists_results in self.parse_chunks(chunks):
+            yield from zip(songs, artists_results)
+
+    # Applies the changes of a --plan file in batches, skipping the items that were
+    # removed or whose artist, title or artists changed since the plan was made.
+    # The number of lines applied is kept in FILE.progress until the whole plan is
+    # applied, so an interrupted --apply continues where it stopped.
+    def apply_plan(self, lib, path):
+        progress_path = f"{path}.progress"
+        offset = 0
+        if os.path.exists(progress_path):
+            with open(progress_path, encoding="utf-8") as f:
+                offset = int(f.read().strip() or 0)
+            print_(f"Resuming {path} after {offset} changes")
+        applied = 0
+        skipped = 0
+        with open(path, encoding="utf-8") as plan_file:
+            lines = itertools.islice(plan_file, offset, None)
+            for batch in batched(lines, self.config["db_batch_size"].get(int)):
+                batch_changes = []
+                written = set()
+                for line in batch:
+                    record = json.loads(line)
+                    song = lib.get_item(record["id"])
+                    if (
+                        song is None
+                        or parse_input_fingerprint(song_parse_input(song))
+                        != record["fingerprint"]
+                    ):
+                        self._log.info(f"Skipping item {record['id']}, it changed")
+                        skipped += 1
+                        continue
+                    if record.get("mtime") is not None:
+                        # Written by a --shard --write-files run
+                        song.mtime = record["mtime"]
+                        written.add(song.id)
+                    batch_changes.append((song, record["new"]))
+                self.apply_changes(lib, batch_changes, written)
+                applied += len(batch_changes)
+                offset += len(batch)
+                with open(progress_path, "w", encoding="utf-8") as f:
+                    f.write(str(offset))
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        print_(f"Applied {applied} changes, skipped {skipped} items that changed")
+        self.report_write_failures()
+
+    def report_write_failures(self):
+        if self.write_failures:
+            print_(f"{len(self.write_failures)} files could not be written:")
+            for description, error in self.write_failures:
+                print_(f"{description}: {error}")
+            self.write_failures = []
+
+    # Yields the changes to apply, asking about each one if keep_asking
+    def confirmed_changes(self, changes, keep_asking):
+        for change in changes:
             if keep_asking:
                 print_(f"---")
-                print_(f"{song}: " + str(final_list))
+                print_(f"{change.description}: " + str(change.new))
                 confirm_item = input(
-                    f"Changing from {artists} => new: {final_list}. Confirm? (y/n)\n"
+                    f"Changing from {change.old} => new: {change.new}. Confirm? (y/n)\n"
                 ).lower()
-            if not lists_have_same_strings(artists, final_list) and (
-                not keep_asking or confirm_item in ["y", "yes"]
-            ):
-                song["artists"] = final_list
-                if should_write():
-                    song.try_write()
-                song.store()
+                if confirm_item not in ["y", "yes"]:
+                    continue
+            yield change
+
+    # Sets the artists of a batch of (song, artists) changes, writes the files and
+    # stores the items in one transaction, so an interrupted run keeps the finished
+    # batches. Files are written by the write_pool threads when there is one, the
+    # items are always stored from this thread. The files of the songs whose ids
+    # are in written already have these artists and aren't written again (see
+    # --shard --write-files)
+    def apply_changes(self, lib, changes, written=()):
+        songs = []
+        for song, artists in changes:
+            song["artists"] = artists
+            if self.config["auto_update"]:
+                song[SOURCE_FIELD] = artists_source(song)
+            songs.append(song)
+        if should_write():
+            self.write_songs([x for x in songs if x.id not in written])
+        self.storing_changes = True
+        try:
+            with lib.transaction():
+                for song in songs:
+                    song.store()
+        finally:
+            self.storing_changes = False
+
+    # Writes the tags of songs to their files, in write_pool if there is one, and
+    # returns the error (or None) of each song. Failures are reported at the end.
+    def write_songs(self, songs):
+        write = functools.partial(
+            write_song, artists_only=self.config["write_artists_only"].get(bool)
+        )
+        if self.write_pool is None:
+            errors = list(map(write, songs))
+        else:
+            errors = list(self.write_pool.map(write, songs))
+        for song, error in zip(songs, errors):
+            if error is not None:
+                self._log.error(error)
+                self.write_failures.append((f"{song}", error))
+        return errors
+
+    def item_changed(self, lib, model):
+        if isinstance(model, Item) and not self.storing_changes:
+            self.changed_item_ids.add(model.id)
+
+    # Derives the artists of the items changed in this beet command again (e.g. after
+    # beet modify artist=... or mbsync) and stores the ones that changed in one
+    # transaction. database_change doesn't tell which fields changed, so the
+    # artist and title the artists were derived from are kept in SOURCE_FIELD, and
+    # only the items whose artist or title changed since (or that have no source
+    # yet) are parsed again, so an edit of the artists (or another field) of an
+    # item the plugin derived the artists of is never undone.
+    def update_changed_items(self, lib):
+        if not self.changed_item_ids:
+            return
+        item_ids = sorted(self.changed_item_ids)
+        self.changed_item_ids.clear()
+        self.load_library_artists(lib)
+        sources = select_item_flex_values(lib, item_ids, SOURCE_FIELD)
+        songs = [
+            song
+            for song in select_item_rows_by_id(lib, item_ids)
+            if sources.get(song["id"]) != artists_source(song)
+            and (self.overwrite or not song["artists"])
+        ]
+        artists_results = self.get_artists_many([song_parse_input(x) for x in songs])
+        changes = []
+        unchanged_sources = []
+        for song, artists_result in zip(songs, artists_results):
+            if lists_have_same_strings(song["artists"], artists_result):
+                unchanged_sources.append((song["id"], artists_source(song)))
+            else:
+                changes.append((lib.get_item(song["id"]), artists_result))
+        self.record_sources(lib, unchanged_sources)
+        if changes:
+            self._log.info(f"Updating the artists of {len(changes)} changed items")
+            self.apply_changes(lib, changes)
+            self.report_write_failures()
+
+    # Records the artists_source of the items whose artists stay as they are, from
+    # (item id, artists_source) pairs. Only the missing or outdated sources are
+    # written, straight to the flexible attributes table, so the items aren't
+    # stored again (and send no database_change).
+    def record_sources(self, lib, item_sources):
+        if not self.config["auto_update"] or not item_sources:
+            return
+        item_sources = dict(item_sources)
+        stored_sources = select_item_flex_values(lib, list(item_sources), SOURCE_FIELD)
+        with lib.transaction() as tx:
+            for item_id, source in item_sources.items():
+                if stored_sources.get(item_id) != source:
+                    tx.mutate(
+                        "INSERT INTO item_attributes (entity_id, key, value) "
+                        "VALUES (?, ?, ?)",
+                        (item_id, SOURCE_FIELD, source),
+                    )
+
+    # The plugin's own SQLite file for the parse cache and the time of the last
+    # runs, by default autoartists.db next to the library
+    def state_path(self, lib):
+        if self.config["cache_path"].get():
+            return self.config["cache_path"].as_filename()
+        library_path = os.fsdecode(lib.path)
+        if library_path == ":memory:":
+            return library_path
+        return os.path.join(os.path.dirname(library_path), "autoartists.db")
+
+    def open_parse_cache(self, lib):
+        path = self.state_path(lib)
+        self.parse_cache = ParseCache(
+            path,
+            parse_config_fingerprint(
+                self.parser.single_artists,
+                self.separators,
+                self.feat_keywords,
+                self.parser.single_artist_matcher.index_stamp(),
+            ),
+            max_size=self.config["cache_size"].get(int),
+        )
+        self._log.debug(f"Parse cache: {path}")
+
+    def close_parse_cache(self):
+        if self.parse_cache is not None:
+            self.parse_cache.close()
+            self.parse_cache = None
+
+    # Yields (songs, artists results) for each list of songs in chunks, in order.
+    # Results are looked up in the parse cache first. The other songs are parsed in
+    # the parse_pool processes when there is one, with up to two chunks per process
+    # in flight while the next chunks are read from the library.
+    def parse_chunks(self, chunks):
+        pending = collections.deque()
+        for songs in chunks:
+            pending.append(self.submit_parse(songs))
+            if len(pending) > 2 * self.parse_jobs:
+                yield self.finish_parse(*pending.popleft())
+        while pending:
+            yield self.finish_parse(*pending.popleft())
+
+    def submit_parse(self, songs):
+        inputs = [song_parse_input(x) for x in songs]
+        if self.parse_cache is None:
+            results = [None] * len(inputs)
+        else:
+            results = [self.parse_cache.get(*x) for x in inputs]
+        missing = [x for x, result in zip(inputs, results) if result is None]
+        if self.parse_pool is None:
+            parsed = self.parser.get_artists_many(missing)
+        else:
+            parsed = self.parse_pool.submit(parse_in_worker, missing)
+        return songs, inputs, results, parsed
+
+    def finish_parse(self, songs, inputs, results, parsed):
+        if isinstance(parsed, concurrent.futures.Future):
+            parsed = parsed.result()
+        parsed = iter(parsed)
+        for i, parse_input in enumerate(inputs):
+            if results[i] is None:
+                results[i] = next(parsed)
+                if self.parse_cache is not None:
+                    self.parse_cache.put(*parse_input, results[i])
+        if self.shadow_fraction > 0:
+            self.shadow_check(inputs, results)
+        return songs, results
+
+    # Parses a random shadow_fraction of inputs with the reference parser too, and
+    # counts and logs the ones where its results differ from results
+    def shadow_check(self, inputs, results):
+        sample = [
+            i
+            for i in range(len(inputs))
+            if self.shadow_random.random() < self.shadow_fraction
+        ]
+        if not sample:
+            return
+        if self.reference_parser is None:
+            self.reference_parser = ReferenceArtistParser(*self.parser.__getstate__())
+        reference_results = self.reference_parser.get_artists_many(
+            [inputs[i] for i in sample]
+        )
+        for i, reference_result in zip(sample, reference_results):
+            self.shadow_checked += 1
+            if reference_result != results[i]:
+                self.shadow_diverged += 1
+                self._log.warning(
+                    f"Parser differs from the reference for {inputs[i]}: "
+                    f"{results[i]} != {reference_result}"
+                )
+
+    def report_shadow(self, lib):
+        if self.shadow_checked:
+            self._log.info(
+                f"Shadow check: {self.shadow_diverged} of {self.shadow_checked} "
+                "items differ from the reference parser"
+            )
+
+    # --verify-engine: parses the items in the query with the parser and the
+    # reference parser, chunk_size items at a time in jobs processes (all the CPUs
+    # by default), and prints the items where they differ
+    def verify_engine(self, lib, args):
+        query, sort = parse_query_parts(decargs(args), Item)
+        chunk_size = self.config["chunk_size"].get(int)
+        songs = select_item_rows(lib, query, chunk_size)
+        if songs is None:
+            songs = iter_items_chunked(lib, query, sort, chunk_size)
+        pool = self.parse_pool
+        jobs = self.parse_jobs
+        if pool is None:
+            jobs = os.cpu_count() or 1
+            pool = concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=init_parse_worker, initargs=(self.parser,)
+            )
+        checked = 0
+        differences = 0
+        pending = collections.deque()
+
+        def report(chunk, future):
+            nonlocal differences
+            for i, reference_result, result in future.result():
+                differences += 1
+                print_(f"{describe_song(lib, chunk[i])}:")
+                print_(f"reference: {reference_result} != parser: {result}")
+
+        try:
+            for chunk in batched(songs, chunk_size):
+                checked += len(chunk)
+                inputs = [song_parse_input(x) for x in chunk]
+                pending.append((chunk, pool.submit(verify_in_worker, inputs)))
+                if len(pending) > 2 * jobs:
+                    report(*pending.popleft())
+            while pending:
+                report(*pending.popleft())
+        finally:
+            if pool is not self.parse_pool:
+                pool.shutdown()
+        print_(f"Verified {checked} items, {differences} differ from the reference")
+        if differences:
+            exit(1)
 
     # input: artist and title are strings from the song, artists is the list of
     # strings of artist names the song already has or None
     # output: returns a list of strings of artists correspoding to the artist/title/artists
+    def get_artists(self, artist, title, artists=None):
+        return self.parser.get_artists(artist, title, artists)
+
+    # get_artists for a list of (artist, title, artists) tuples, see
+    # ArtistParser.get_artists_many
+    def get_artists_many(self, inputs):
+        results = self.parser.get_artists_many(inputs)
+        if self.shadow_fraction > 0:
+            self.shadow_check(inputs, results)
+        return results
+
+    def imported(self, session, task):
+        self.load_library_artists(session.lib)
+        if self.config["stats"] and self.stats is None:
+            self.start_stats()
+        changed_songs = []
+        songs = task.imported_items()
+        artists_results = self.get_artists_many([song_parse_input(x) for x in songs])
+        # After the import stages the importer writes the files of the tasks it applied
+        # metadata to, including the artists stored here, so only write the others
+        # (e.g. imported as-is) to not write each file twice
+        importer_writes = task.apply or task.choice_flag == Action.RETAG
+        for song, artists_result in zip(songs, artists_results):
+            existing_artists = None if "artists" not in song else song["artists"]
+            self._log.info(f"Autoartists: {song} has artists {existing_artists}")
+            # The importer stores all the songs after the import stages
+            if self.config["auto_update"]:
+                song[SOURCE_FIELD] = artists_source(song)
+            if not lists_have_same_strings(existing_artists, artists_result):
+                song["artists"] = artists_result
+                if should_write() and not importer_writes:
+                    error = write_song(
+                        song, self.config["write_artists_only"].get(bool)
+                    )
+                    if error is not None:
+                        self._log.error(error)
+                changed_songs.append(song)
+        self.storing_changes = True
+        try:
+            for batch in batched(changed_songs, self.config["db_batch_size"].get(int)):
+                with session.lib.transaction():
+                    for song in batch:
+                        song.store()
+                        self._log.info(
+                            f"Autoartists: Added artists {song['artists']} to {song}"
+                        )
+        finally:
+            self.storing_changes = False
+
+    # With library_artists, adds the names in the library index which would be split
+    # otherwise to the single artists of the parser (once per beet command). The
+    # index is built the first time, then kept up to date from the library events.
+    def load_library_artists(self, lib):
+        if not self.config["library_artists"] or self.library_artists_loaded:
+            return
+        self.library_artists_loaded = True
+        self.flush_library_artists(lib)
+        index = LibraryArtistIndex(self.state_path(lib))
+        try:
+            if not index.is_built():
+                self._log.info("Building the index of the artists in the library")
+                index.rebuild(iter_item_artist_names(lib))
+            names = index.names(self.separators, self.feat_keywords)
+        finally:
+            index.close()
+        self._log.debug(f"{len(names)} single artists from the library")
+        if names:
+            self.parser = ArtistParser(
+                self.single_artist_list + names,
+                self.separators,
+                self.feat_keywords,
+                self.single_artists_file,
+            )
+
+    def rebuild_library_artists(self, lib):
+        self.library_artists_dirty.clear()
+        index = LibraryArtistIndex(self.state_path(lib))
+        try:
+            index.rebuild(iter_item_artist_names(lib))
+            print_(f"Indexed {index.count()} artist names in the library")
+        finally:
+            index.close()
+
+    def library_item_imported(self, lib, item):
+        self.library_artists_dirty.add(item.id)
+
+    def library_changed(self, lib, model):
+        if isinstance(model, Item):
+            self.library_artists_dirty.add(model.id)
+
+    def library_item_removed(self, item):
+        self.library_artists_dirty.add(item.id)
+
+    # Updates the library artist index for the items changed in this beet command,
+    # in one transaction when it exits (or before the index is read)
+    def flush_library_artists(self, lib):
+        if not self.library_artists_dirty:
+            return
+        item_ids = sorted(self.library_artists_dirty)
+        self.library_artists_dirty.clear()
+        index = LibraryArtistIndex(self.state_path(lib))
+        try:
+            if index.is_built():
+                index.update(item_ids, iter_item_artist_names(lib, item_ids))
+        finally:
+            index.close()
+
+
+# Wall time and number of calls of each stage of a run, for --stats. The stages are
+# timed by replacing the functions that do them with timed wrappers until
+# uninstrument, so nothing is added to the code when stats are off. Stages can
+# include others (get_artists includes the matching, splitting and normalization),
+# and with jobs the parsing happens in the worker processes, where it isn't timed.
+class StageStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.times = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.instrumented = []
+
+    def timed(self, stage, function):
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[stage] += time.perf_counter() - start
+                self.counts[stage] += 1
+
+        return timed_function
+
+    # Yields from iterable, timing each item as a call of stage
+    def timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.times[stage] += time.perf_counter() - start
+            self.counts[stage] += 1
+            yield item
+
+    # Replaces obj.attribute (a method or module function) with a timed version
+    def instrument(self, obj, attribute, stage):
+        original = getattr(obj, attribute)
+        own_attribute = attribute in vars(obj)
+        setattr(obj, attribute, self.timed(stage, original))
+        self.instrumented.append((obj, attribute, original, own_attribute))
+
+    def uninstrument(self):
+        for obj, attribute, original, own_attribute in reversed(self.instrumented):
+            if own_attribute:
+                setattr(obj, attribute, original)
+            else:
+                delattr(obj, attribute)
+        self.instrumented = []
+
+    # Returns a line per stage, the slowest first, and the total
+    def summary(self):
+        lines = [
+            f"{stage}: {seconds:.3f}s, {self.counts[stage]} calls"
+            for stage, seconds in sorted(
+                self.times.items(), key=lambda x: x[1], reverse=True
+            )
+        ]
+        lines.append(f"total: {time.perf_counter() - self.started:.3f}s")
+        return lines
+
+
+# The artist parsing of the plugin, built from its single_artists (and
+# single_artists_file), separators and feat_keywords config. It only pickles its
+# config, so it can be sent to worker processes, where the matchers are built again
+# (once per process).
+class ArtistParser:
+    def __init__(
+        self, single_artists, separators, feat_keywords, single_artists_file=None
+    ):
+        self.single_artists = list(single_artists)
+        self.separators = list(separators)
+        self.feat_keywords = list(feat_keywords)
+        self.single_artists_file = single_artists_file
+        self.single_artist_matcher = get_single_artist_matcher(
+            self.single_artists, single_artists_file
+        )
+        self.separator_splitter = get_separator_splitter(self.separators)
+        self.feat_extractor = get_feat_extractor(self.feat_keywords)
+
+    def __getstate__(self):
+        return (
+            self.single_artists,
+            self.separators,
+            self.feat_keywords,
+            self.single_artists_file,
+        )
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    # input: artist and title are strings from the song, artists is the list of
+    # strings of artist names the song already has or None
+    # output: returns a list of strings of artists correspoding to the artist/title/artists
+    def get_artists(self, artist, title, artists=None):
+        artist_artists, track_artist = self.parse_artist(artist)
+        title_artists = []
+        for featured_artist_string in self.feat_extractor.extract_title(title):
+            title_artists += self.split(featured_artist_string)
+        return self.combine(artists, artist_artists, title_artists, track_artist)
+
+    # input: a list of (artist, title, artists) tuples
+    # output: the list of get_artists results for them, in the same order
+    # Each distinct artist string and featured artist clause of the titles is only
+    # parsed once
+    def get_artists_many(self, inputs):
+        artist_parses = {}
+        title_clause_parses = {}
+        results = []
+        for artist, title, artists in inputs:
+            if artist not in artist_parses:
+                artist_parses[artist] = self.parse_artist(artist)
+            artist_artists, track_artist = artist_parses[artist]
+            title_artists = []
+            for featured_artist_string in self.feat_extractor.extract_title(title):
+                if featured_artist_string not in title_clause_parses:
+                    title_clause_parses[featured_artist_string] = self.split(
+                        featured_artist_string
+                    )
+                title_artists += title_clause_parses[featured_artist_string]
+            results.append(
+                self.combine(artists, artist_artists, title_artists, track_artist)
+            )
+        return results
+
+    # Returns the artists in an artist string (single artists first) and the string
+    # that is the track artist, if it has no featured artists, or None
+    def parse_artist(self, artist):
+        auto_artists = []
+        single_artist_matches = self.single_artist_matcher.find(artist)
+        for start, end, single_artist in single_artist_matches:
+            log.debug(f"single artist {single_artist}: {artist}")
+            auto_artists.append(single_artist)
+        if single_artist_matches:
+            artist = remove_matches(artist, single_artist_matches)
+            log.debug(f"artist is now {artist}")
+        artist, featured_artist_strings = self.feat_extractor.extract_artist(artist)
+        if featured_artist_strings:
+            log.debug(f"featured artists {featured_artist_strings}: {artist}")
+        for artist_string in [artist] + featured_artist_strings:
+            auto_artists += self.split(artist_string)
+        # Only an artist string without featured artists can be the track artist
+        if featured_artist_strings:
+            artist = None
+        return auto_artists, artist
+
+    def split(self, artists_string):
+        return split_artists_string(
+            artists_string,
+            self.single_artist_matcher,
+            separators=self.separator_splitter,
+        )
+
+    # Returns the final list of artists from the existing artists (or None) and the
+    # ones found in the artist and title. Duplicates are dropped, keeping the first.
+    def combine(self, artists, artist_artists, title_artists, track_artist):
+        auto_artists = (artists or []) + artist_artists + title_artists
+        auto_artists = [x.strip() for x in auto_artists]
+
+        # final cleanups
+        final_list = []
+        normalized_artists_strings = []
+        for auto_artist in auto_artists:
+            normalized_artist = normalize_string(auto_artist)
+            if (
+                auto_artist.lower() != "various artists"
+                and auto_artist not in final_list
+                and len(auto_artist) > 0
+                and normalized_artist not in normalized_artists_strings
+            ):
+                normalized_artists_strings.append(normalized_artist)
+                # Put the track artist first, otherwise add at the end
+                if auto_artist == track_artist:
+                    final_list.insert(0, auto_artist)
+                else:
+                    log.debug(f"Adding artist {auto_artist}")
+                    final_list.append(auto_artist)
+        return final_list
+
+
+# The artist parsing of the plugin before ArtistParser, kept as it was, to check
+# that ArtistParser (and future parsers) only change results on purpose, see
+# --verify-engine and shadow_fraction. It has its own single artist, separator and
+# feat handling and final cleanup, and parses each item on its own. The names of
+# single_artists_file are single artists too; feat_keywords are ignored, it only
+# knows its own.
+class ReferenceArtistParser:
+    def __init__(
+        self, single_artists, separators, feat_keywords, single_artists_file=None
+    ):
+        self.single_artist_list = list(single_artists)
+        if single_artists_file is not None:
+            try:
+                with open(single_artists_file, encoding="utf-8") as f:
+                    names = [x.rstrip("\r\n") for x in f if x.strip()]
+            except (OSError, ValueError) as e:
+                log.error(
+                    f"Could not read {single_artists_file}, ignoring its names: {e}"
+                )
+                names = []
+            self.single_artist_list += names
+        self.separators = list(separators)
+
     def get_artists(self, artist, title, artists=None):
         auto_artists = []
         if artists:
             auto_artists = auto_artists + artists
         for single_artist in self.single_artist_list:
             if single_artist.lower() in artist.lower():
-                self._log.debug(f"single artist {single_artist}: {artist}")
+                log.debug(f"single artist {single_artist}: {artist}")
                 if single_artist not in auto_artists:
                     auto_artists = auto_artists + [single_artist]
                 artist = re.sub(re.escape(single_artist), "", artist, re.IGNORECASE)
-                self._log.debug(f"artist is now {artist}")
+                log.debug(f"artist is now {artist}")
         for i in ["(feat. ", "(featuring ", "(with "]:
             if i in artist.lower():
                 artist = re.sub(
@@ -184,11 +1242,11 @@ class AutoArtistsPlugin(BeetsPlugin):
         for i in [" feat. ", " featuring ", " Feat. ", " Featuring "]:
             if i in artist:
                 artist = artist.replace(i, ", ")
-        for new_artist in split_artists_string(
+        for new_artist in reference_split_artists_string(
             artist, self.single_artist_list, separators=self.separators
         ):
             if new_artist not in auto_artists:
-                self._log.debug(f"Adding artist {new_artist}")
+                log.debug(f"Adding artist {new_artist}")
                 auto_artists.append(new_artist)
         if re.match(
             r".* [\(\[](feat\.?|with|featuring) ([^)\]]*)[\)\]].*", title, re.IGNORECASE
@@ -199,7 +1257,7 @@ class AutoArtistsPlugin(BeetsPlugin):
                 title,
                 flags=re.IGNORECASE,
             )
-            featured_artists = split_artists_string(
+            featured_artists = reference_split_artists_string(
                 featured_artist_string,
                 self.single_artist_list,
                 separators=self.separators,
@@ -214,7 +1272,7 @@ class AutoArtistsPlugin(BeetsPlugin):
         final_list = []
         normalized_artists_strings = []
         for auto_artist in auto_artists:
-            normalized_artist = normalize_string(auto_artist)
+            normalized_artist = reference_normalize_string(auto_artist)
             if (
                 auto_artist.lower() != "various artists"
                 and auto_artist not in final_list
@@ -229,27 +1287,13 @@ class AutoArtistsPlugin(BeetsPlugin):
                     final_list.append(auto_artist)
         return final_list
 
-    def imported(self, session, task):
-        for song in task.imported_items():
-            artist = str(song["artist"])
-            title = str(song["title"])
-            existing_artists = None if "artists" not in song else song["artists"]
-            artists_result = self.get_artists(
-                artist=artist, title=title, artists=existing_artists
-            )
-            self._log.info(f"Autoartists: {song} has artists {existing_artists}")
-            if not lists_have_same_strings(existing_artists, artists_result):
-                song["artists"] = artists_result
-                if should_write():
-                    song.try_write()
-                song.store()
-                self._log.info(f"Autoartists: Added artists {artists_result} to {song}")
+    def get_artists_many(self, inputs):
+        return [self.get_artists(*x) for x in inputs]
 
 
-# Input: artists_string is a string with one or multiple artists
-# single_artists is a list of strings which should be treated as one artist (do not separate them)
-# Output: A list of strings of the artist names in artists_string
-def split_artists_string(
+# split_artists_string of ReferenceArtistParser, as it was before the single
+# artist matcher and the SeparatorSplitter
+def reference_split_artists_string(
     artists_string,
     single_artists,
     separators=["␟", ", ", " & ", " and ", " + ", " with ", "/", ";"],
@@ -275,28 +1319,993 @@ def split_artists_string(
     return artists
 
 
-# a,b are lists of strings
+# normalize_string of ReferenceArtistParser, without the cache and the ASCII shortcut
+def reference_normalize_string(string_in):
+    new_string = string_in.lower()
+    remove_symbols = ["'", "`", "’"]
+    replace_with_space = [" - ", ": "]
+    for r in replace_with_space:
+        new_string = new_string.replace(r, " ")
+    new_string = "".join(
+        char
+        for char in unicodedata.normalize("NFD", new_string.lower())
+        if char not in remove_symbols and unicodedata.category(char) != "Mn"
+    )
+    new_string = (
+        new_string.replace("’", "'")
+        .replace("…", "...")
+        .replace("‐", "-")
+        .replace("  ", " ")
+    )
+    return new_string
+
+
+# The parser of a parse_pool worker process, set by init_parse_worker
+_worker_parser = None
+
+
+def init_parse_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+
+# Runs in a parse_pool worker process, inputs is a list of (artist, title, artists)
+def parse_in_worker(inputs):
+    return _worker_parser.get_artists_many(inputs)
+
+
+# The ReferenceArtistParser of a worker process, for verify_in_worker
+_worker_reference_parser = None
+
+
+# Runs in a worker process, returns (index, reference result, result) for the
+# inputs where the parser and the reference parser differ
+def verify_in_worker(inputs):
+    global _worker_reference_parser
+    if _worker_reference_parser is None:
+        _worker_reference_parser = ReferenceArtistParser(*_worker_parser.__getstate__())
+    results = _worker_parser.get_artists_many(inputs)
+    reference_results = _worker_reference_parser.get_artists_many(inputs)
+    return [
+        (i, reference_result, result)
+        for i, (reference_result, result) in enumerate(zip(reference_results, results))
+        if reference_result != result
+    ]
+
+
+# Returns the (artist, title, artists) that get_artists takes for a song
+def song_parse_input(song):
+    artists = None if "artists" not in song else song["artists"]
+    return (str(song["artist"]), str(song["title"]), artists)
+
+
+# Writes the tags of song to its file, returns the error message if that failed
+def write_song(song, artists_only=False):
+    try:
+        if artists_only:
+            write_song_artists(song)
+        else:
+            song.write()
+    except FileOperationError as exc:
+        return str(exc)
+    return None
+
+
+# Writes only the artists tag of song to its file, instead of all the tags like
+# Item.write (whose tags argument only adds tags). Files which already have these
+# artists are not written at all. Can raise ReadError or WriteError like Item.write.
+def write_song_artists(song):
+    path = song.path
+    try:
+        mediafile = MediaFile(syspath(path), id3v23=config["id3v23"].get(bool))
+    except UnreadableFileError as exc:
+        raise ReadError(path, exc)
+    tags = {"artists": list(song.get("artists") or [])}
+    if (mediafile.artists or []) == tags["artists"]:
+        return False
+    plugins.send("write", item=song, path=path, tags=tags)
+    mediafile.update(tags)
+    try:
+        mediafile.save()
+    except UnreadableFileError as exc:
+        raise WriteError(path, exc)
+    song.mtime = song.current_mtime()
+    plugins.send("after_write", item=song, path=path)
+    return True
+
+
+# Yields lists of up to size items from iterable
+def batched(iterable, size):
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Like batched for an iterable of lists, without splitting them: yields the items
+# of whole lists, up to size items unless a single list is larger
+def batched_groups(groups, size):
+    batch = []
+    for group in groups:
+        if batch and len(batch) + len(group) > size:
+            yield batch
+            batch = []
+        batch.extend(group)
+    if batch:
+        yield batch
+
+
+# Input: artists_string is a string with one or multiple artists
+# single_artists is a list of strings (or a SingleArtistMatcher built from one)
+# which should be treated as one artist (do not separate them)
+# separators is a list of strings (or a SeparatorSplitter built from one)
+# Output: A list of strings of the artist names in artists_string
+def split_artists_string(
+    artists_string,
+    single_artists,
+    separators=["␟", ", ", " & ", " and ", " + ", " with ", "/", ";"],
+):
+    if not isinstance(separators, SeparatorSplitter):
+        separators = get_separator_splitter(separators)
+    if not isinstance(single_artists, SingleArtistMatcher):
+        single_artists = get_single_artist_matcher(single_artists)
+    matches = single_artists.find(artists_string)
+    artists = [name for start, end, name in matches]
+    if len(matches) == 1 and matches[0][:2] == (0, len(artists_string)):
+        return artists
+    artists_string = remove_matches(artists_string, matches)
+    artists = [
+        x for x in (separators.split(artists_string) + artists) if x not in ["", " "]
+    ]
+    return artists
+
+
+# Splits a string on all the separators in one pass, with a single regex alternation
+# compiled once from the config. At each position the separators are tried in config
+# order, so the result is the same as replacing each of them with the first one and
+# splitting on that, except when two separators overlap in the text (e.g. " with and "
+# with the default separators), where the one that starts first wins.
+class SeparatorSplitter:
+    def __init__(self, separators):
+        self.separators = list(separators)
+        alternatives = [re.escape(x) for x in self.separators if x]
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+    def split(self, string):
+        if self.pattern is None:
+            return [string]
+        return self.pattern.split(string)
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_separator_splitter(separators):
+    return SeparatorSplitter(separators)
+
+
+# Feat keywords which are only read in brackets, "Artist (with Other)", because they
+# are also words of band names ("Death With Dignity")
+BRACKET_ONLY_FEAT_KEYWORDS = ["with"]
+
+
+# Finds featured artist clauses with one precompiled regex per field, built from the
+# feat_keywords config.
+# In an artist string the clause is either bracketed, "Artist (feat. Other)", or
+# inline, "Artist feat. Other", and keywords match exactly as written. Bracketed
+# keywords match in any case, inline ones only as written or capitalized ("Feat.")
+# and not the BRACKET_ONLY_FEAT_KEYWORDS.
+# In a title only the last bracketed clause preceded by a space counts, so
+# "You Belong With Me" is not read as featuring "Me", and a keyword ending in "."
+# also matches without the dot ("(feat Other)").
+class FeatExtractor:
+    def __init__(self, feat_keywords):
+        self.feat_keywords = list(feat_keywords)
+        keywords = feat_keywords_pattern(self.feat_keywords, optional_dot=False)
+        if not keywords:
+            self.artist_pattern = self.title_pattern = None
+            return
+        inline_keywords = [
+            y
+            for x in self.feat_keywords
+            if x.lower() not in BRACKET_ONLY_FEAT_KEYWORDS
+            for y in dict.fromkeys([x, x[:1].upper() + x[1:]])
+        ]
+        artist_pattern = rf"(?i:[\(\[](?:{keywords}) (?P<bracketed>[^)\]]*)[\)\]])"
+        inline_pattern = feat_keywords_pattern(inline_keywords, optional_dot=False)
+        if inline_pattern:
+            artist_pattern += rf"|(?P<inline> (?:{inline_pattern}) )"
+        self.artist_pattern = re.compile(artist_pattern)
+        title_keywords = feat_keywords_pattern(self.feat_keywords)
+        self.title_pattern = re.compile(
+            rf".* [\(\[](?:{title_keywords}) ([^)\]]*)[\)\]]", re.IGNORECASE
+        )
+
+    # Returns (main artist string, list of featured artist strings)
+    # Text after a bracketed clause, like " (Live)", is dropped
+    def extract_artist(self, artist):
+        if self.artist_pattern is None:
+            return artist, []
+        matches = list(self.artist_pattern.finditer(artist))
+        if not matches:
+            return artist, []
+        featured = []
+        for match, next_match in zip(matches, matches[1:] + [None]):
+            if match["bracketed"] is not None:
+                featured.append(match["bracketed"])
+            else:
+                end = next_match.start() if next_match else len(artist)
+                featured.append(artist[match.end() : end])
+        return artist[: matches[0].start()], featured
+
+    # Returns a list with the featured artist string of the title, or an empty list
+    def extract_title(self, title):
+        if self.title_pattern is None:
+            return []
+        match = self.title_pattern.match(title)
+        return [match[1]] if match else []
+
+
+# Returns a regex alternation of keywords, longest first, where a keyword ending in
+# "." also matches without it if optional_dot
+def feat_keywords_pattern(keywords, optional_dot=True):
+    return "|".join(
+        re.escape(x[:-1]) + r"\.?" if optional_dot and x.endswith(".") else re.escape(x)
+        for x in sorted(keywords, key=len, reverse=True)
+        if x
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_feat_extractor(feat_keywords):
+    return FeatExtractor(feat_keywords)
+
+
+def get_feat_extractor(feat_keywords):
+    return _cached_feat_extractor(tuple(feat_keywords))
+
+
+# Builds (or reuses) the splitter for a list of separators, so plugin instances and
+# calls with the same separators share one compiled pattern
+def get_separator_splitter(separators):
+    return _cached_separator_splitter(tuple(separators))
+
+
+# A case-insensitive trie of the single_artists whitelist, built from the config on
+# the first find(), so beet commands that don't parse anything don't pay for it.
+# find() scans a string in one pass and returns every whitelisted name in it as
+# (start, end, name) tuples, leftmost-longest and non-overlapping, where name is
+# spelled as in the config. The cost of a scan depends on the length of the string
+# and of the longest matching name, not on the number of names in the whitelist.
+# Names from a SingleArtistIndex (single_artists_file) are matched as well, the
+# longest match wins and the config list wins a tie.
+class SingleArtistMatcher:
+    def __init__(self, single_artists, index=None):
+        self.single_artists = list(single_artists)
+        self.index = index
+
+    # Each node is a dict of lowercased character -> child node, the key None holds
+    # the name that ends at that node
+    @functools.cached_property
+    def root(self):
+        root = {}
+        for name in self.single_artists:
+            node = root
+            for char in name:
+                node = node.setdefault(char.lower(), {})
+            if node is not root:
+                node.setdefault(None, name)
+        return root
+
+    def __len__(self):
+        return len(self.single_artists) + (len(self.index) if self.index else 0)
+
+    # The source stamp of the index (see SingleArtistIndex), None without one
+    def index_stamp(self):
+        return None if self.index is None else self.index.source_stamp
+
+    def find(self, string):
+        matches = []
+        if not self.single_artists and not self.index:
+            return matches
+        # Lowercase per character so positions line up with the original string
+        keys = [char.lower() for char in string]
+        start = 0
+        while start < len(keys):
+            match = self.longest_match(keys, start)
+            if self.index:
+                index_match = self.index.longest_match(keys, start)
+                if index_match and (match is None or index_match[0] > match[0]):
+                    match = index_match
+            if match:
+                matches.append((start, *match))
+                start = match[0]
+            else:
+                start += 1
+        return matches
+
+    # Returns (end, name) for the longest name in the trie that starts at keys[start]
+    # or None
+    def longest_match(self, keys, start):
+        node = self.root
+        match = None
+        position = start
+        while position < len(keys):
+            node = node.get(keys[position])
+            if node is None:
+                break
+            position += 1
+            if None in node:
+                match = (position, node[None])
+        return match
+
+
+# Builds (or reuses) the matcher for a list of single artists and a
+# single_artists_file, so plugin instances and calls with the same whitelist share
+# one trie and index
+@functools.lru_cache(maxsize=8)
+def _cached_single_artist_matcher(single_artists, single_artists_file, source_stamp):
+    index = None
+    if single_artists_file is not None:
+        try:
+            index = SingleArtistIndex(single_artists_file)
+        except (OSError, ValueError) as e:
+            # ValueError: the file isn't UTF-8
+            log.error(f"Could not index {single_artists_file}, ignoring its names: {e}")
+    return SingleArtistMatcher(single_artists, index)
+
+
+def get_single_artist_matcher(single_artists, single_artists_file=None):
+    source_stamp = None
+    if single_artists_file is not None:
+        source_stamp = SingleArtistIndex.stamp(single_artists_file)
+    return _cached_single_artist_matcher(
+        tuple(single_artists), single_artists_file, source_stamp
+    )
+
+
+# The names of a single_artists_file (UTF-8, one name per line) compiled into a
+# sorted string table, which is memory-mapped instead of read, so loading it costs
+# about the same for a few names as for millions. The index is written next to the
+# source as FILE.idx, or in the beets config directory when the source's directory
+# isn't writable, and only rebuilt when the size or mtime of the source changes.
+# Layout: the header, count + 1 offsets of the entries, then the entries sorted by
+# key, each the name lowercased per character (as in SingleArtistMatcher) in UTF-8,
+# a NUL and the name. UTF-8 sorts like the strings, so lookups compare bytes.
+class SingleArtistIndex:
+    MAGIC = b"AUTOAID1"
+    # magic, source size, source mtime in ns, number of names
+    HEADER = struct.Struct("=8sQqQ")
+    CACHED_PREFIX_LENGTH = 3
+
+    def __init__(self, source_path, index_path=None):
+        self.source_path = source_path
+        self.index_path = index_path or f"{source_path}.idx"
+        self.source_stamp = self.stamp(source_path)
+        self.prefix_ranges = {}
+        if self.open():
+            return
+        try:
+            self.build()
+        except OSError as e:
+            if index_path is not None:
+                raise
+            log.warning(f"Could not write the index {self.index_path}: {e}")
+            self.index_path = self.fallback_index_path(source_path)
+            if self.open():
+                return
+            self.build()
+        if not self.open():
+            raise OSError(f"Could not load the index {self.index_path}")
+
+    # The index path in the beets config directory, one per source path
+    @staticmethod
+    def fallback_index_path(source_path):
+        source_hash = hashlib.sha1(os.fsencode(os.path.abspath(source_path)))
+        return os.path.join(
+            config.config_dir(), f"autoartists-{source_hash.hexdigest()[:16]}.idx"
+        )
+
+    @staticmethod
+    def stamp(source_path):
+        stat = os.stat(source_path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def __len__(self):
+        return self.count
+
+    # Maps the index file, returns False if it is missing or not for this source
+    def open(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self.HEADER.size:
+                    return False
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return False
+        magic, size, mtime_ns, count = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or (size, mtime_ns) != self.source_stamp:
+            data.close()
+            return False
+        self.data = data
+        self.count = count
+        start = self.HEADER.size
+        self.offsets = memoryview(data)[start : start + 8 * (count + 1)].cast("Q")
+        return True
+
+    def build(self):
+        entries = {}
+        with open(self.source_path, encoding="utf-8") as f:
+            for line in f:
+                name = line.rstrip("\r\n")
+                if name.strip():
+                    key = "".join(char.lower() for char in name).encode("utf-8")
+                    # Like the config list, the first of names with the same key wins
+                    entries.setdefault(key, name)
+        entries = sorted(entries.items())
+        offsets = array.array("Q")
+        position = self.HEADER.size + 8 * (len(entries) + 1)
+        for key, name in entries:
+            offsets.append(position)
+            position += len(key) + 1 + len(name.encode("utf-8"))
+        offsets.append(position)
+        # Write to a temporary file first, so other beet processes never map half
+        # an index
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, *self.source_stamp, len(entries)))
+                f.write(offsets.tobytes())
+                for key, name in entries:
+                    f.write(key + b"\0" + name.encode("utf-8"))
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def key(self, i):
+        start = self.offsets[i]
+        return self.data[start : self.data.find(b"\0", start, self.offsets[i + 1])]
+
+    def name(self, i):
+        start = self.data.find(b"\0", self.offsets[i], self.offsets[i + 1]) + 1
+        return self.data[start : self.offsets[i + 1]].decode("utf-8")
+
+    # The range of the entries in lo..hi whose keys start with prefix
+    def narrow(self, prefix, lo, hi):
+        lo = self.bisect(prefix, lo, hi)
+        if lo == hi or not self.key(lo).startswith(prefix):
+            return lo, lo
+        # No UTF-8 byte is 0xff, so this is past every key starting with prefix
+        return lo, self.bisect(prefix + b"\xff", lo + 1, hi)
+
+    # The first entry in lo..hi whose key is not less than key
+    def bisect(self, key, lo, hi):
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.key(middle) < key:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    # Returns (end, name) for the longest name in the index that starts at
+    # keys[start] or None. The range of entries starting with the keys read so far
+    # is narrowed one character at a time, and the scan stops when it is empty.
+    # The ranges of short prefixes, which are the widest and are looked up at every
+    # position of every string, are kept in self.prefix_ranges.
+    def longest_match(self, keys, start):
+        lo, hi = 0, self.count
+        prefix = b""
+        match = None
+        for position in range(start, len(keys)):
+            prefix += keys[position].encode("utf-8")
+            if len(prefix) <= self.CACHED_PREFIX_LENGTH:
+                prefix_range = self.prefix_ranges.get(prefix)
+                if prefix_range is None:
+                    prefix_range = self.narrow(prefix, lo, hi)
+                    self.prefix_ranges[prefix] = prefix_range
+                lo, hi = prefix_range
+            else:
+                lo, hi = self.narrow(prefix, lo, hi)
+            if lo == hi:
+                break
+            if self.key(lo) == prefix:
+                match = (position + 1, self.name(lo))
+        return match
+
+
+# Returns string with the (start, end, name) spans from SingleArtistMatcher.find removed
+def remove_matches(string, matches):
+    pieces = []
+    position = 0
+    for start, end, name in matches:
+        pieces.append(string[position:start])
+        position = end
+    pieces.append(string[position:])
+    return "".join(pieces)
+
+
+# A change the autoartists command would make: the item id, the item formatted for
+# display, its old and new artists, and with -a the id of its album
+ArtistsChange = collections.namedtuple(
+    "ArtistsChange", ["id", "description", "old", "new", "album_id"], defaults=[None]
+)
+
+
+# Returns a hash of the (artist, title, artists) of an item, to tell whether it
+# changed since a plan was made
+def parse_input_fingerprint(parse_input):
+    artist, title, artists = parse_input
+    parse_input_json = json.dumps([artist, title, list(artists or [])])
+    return hashlib.sha1(parse_input_json.encode("utf-8")).hexdigest()
+
+
+# The flexible attribute holding artists_source() of the artist and title the
+# artists of an item were derived from, see update_changed_items
+SOURCE_FIELD = "autoartists_source"
+
+
+# Returns a hash of the artist and title of a song (Item or row)
+def artists_source(song):
+    source_json = json.dumps([song["artist"], song["title"]])
+    return hashlib.sha1(source_json.encode("utf-8")).hexdigest()
+
+
+# Returns the JSON line of a --plan file for a song and its new artists
+# mtime is the new mtime of the file if the artists were already written to it
+def plan_record(song, artists_result, mtime=None):
+    parse_input = song_parse_input(song)
+    record = {
+        "id": song["id"],
+        "path": os.fsdecode(song["path"]),
+        "old": parse_input[2] or [],
+        "new": artists_result,
+        "fingerprint": parse_input_fingerprint(parse_input),
+    }
+    if mtime is not None:
+        record["mtime"] = mtime
+    return json.dumps(record, ensure_ascii=False)
+
+
+# The fields of the items that the autoartists command reads
+ITEM_ROW_FIELDS = ["id", "artist", "title", "artists", "path"]
+
+
+# Returns a generator of dicts with the ITEM_ROW_FIELDS of the items matching query,
+# selected straight from the items table chunk_size ids at a time, without loading
+# whole Items. With empty_artists_only, only the items without artists are selected.
+# Returns None when the query can't be done in SQL alone (flexible attributes or
+# album fields), use iter_items_chunked then.
+# With shard (K, N), only the items whose id % N is K - 1 are selected.
+# fields are the selected fields, ITEM_ROW_FIELDS by default.
+# The rows are in id order.
+def select_item_rows(
+    lib, query, chunk_size, empty_artists_only=False, shard=None, fields=None
+):
+    where, subvals = query.clause()
+    if where is None or not set(getattr(query, "field_names", ())) <= set(Item._fields):
+        return None
+    subvals = list(subvals)
+    if empty_artists_only:
+        where = f"({where}) AND (artists IS NULL OR artists = '')"
+    if shard is not None:
+        where = f"({where}) AND id % ? = ?"
+        subvals += [shard[1], shard[0] - 1]
+    return _iter_item_rows(lib, where, subvals, chunk_size, fields or ITEM_ROW_FIELDS)
+
+
+# Returns (K, N) for a --shard K/N string, None if it isn't valid
+def parse_shard(shard):
+    try:
+        k, n = (int(x) for x in shard.split("/"))
+    except ValueError:
+        return None
+    return (k, n) if 1 <= k <= n else None
+
+
+# Returns the sort parts of the query args ("year-"), like beets tells them apart
+def query_sort_parts(args):
+    return [x for x in args if x.endswith(("+", "-")) and ":" not in x and len(x) > 1]
+
+
+def _iter_item_rows(lib, where, subvals, chunk_size, fields=ITEM_ROW_FIELDS):
+    with lib.transaction() as tx:
+        min_id, max_id = tx.query("SELECT MIN(id), MAX(id) FROM items")[0]
+    if min_id is None:
+        return
+    fields = list(dict.fromkeys(fields))
+    columns = ", ".join(fields)
+    for start in range(min_id, max_id + 1, chunk_size):
+        with lib.transaction() as tx:
+            rows = tx.query(
+                f"SELECT {columns} FROM items "
+                f"WHERE ({where}) AND id BETWEEN ? AND ? ORDER BY id",
+                subvals + [start, start + chunk_size - 1],
+            )
+        for row in rows:
+            yield _item_row(row, fields)
+
+
+def _item_row(row, fields=ITEM_ROW_FIELDS):
+    return {
+        field: Item._type(field).from_sql(value) for field, value in zip(fields, row)
+    }
+
+
+# Yields the ITEM_ROW_FIELDS of the items of item_ids that exist, like select_item_rows
+def select_item_rows_by_id(lib, item_ids, chunk_size=500):
+    fields = ", ".join(ITEM_ROW_FIELDS)
+    for ids in batched(item_ids, chunk_size):
+        with lib.transaction() as tx:
+            rows = tx.query(
+                f"SELECT {fields} FROM items "
+                f"WHERE id IN ({', '.join('?' * len(ids))}) ORDER BY id",
+                ids,
+            )
+        for row in rows:
+            yield _item_row(row)
+
+
+# Returns the item fields that format_item uses, so rows from select_item_rows can
+# be listed without loading their Items, or [] if it uses other fields too (album
+# fields, flexible attributes, ...)
+def display_fields():
+    fields = re.findall(r"\$\{?(\w+)", config["format_item"].as_str())
+    if not set(fields) <= set(Item._fields):
+        return []
+    return fields
+
+
+# Returns {item id: value} of the flexible attribute key for the items of item_ids
+# that have it
+def select_item_flex_values(lib, item_ids, key, chunk_size=500):
+    values = {}
+    for ids in batched(item_ids, chunk_size):
+        with lib.transaction() as tx:
+            rows = tx.query(
+                "SELECT entity_id, value FROM item_attributes "
+                f"WHERE key = ? AND entity_id IN ({', '.join('?' * len(ids))})",
+                [key, *ids],
+            )
+        values.update((row[0], row[1]) for row in rows)
+    return values
+
+
+# Returns the song formatted like beets lists it, from the fields of a row from
+# select_item_rows if it has the display_fields(), else loading its Item
+def describe_song(lib, song):
+    if not isinstance(song, Item):
+        fields = display_fields()
+        if fields and set(fields) <= set(song):
+            song = Item(lib, **{x: song[x] for x in fields})
+        else:
+            song = lib.get_item(song["id"])
+    return f"{song}"
+
+
+# Yields the items matching query, loading chunk_size ids worth of rows from the
+# database at a time instead of the whole result. Items are sorted within a chunk.
+def iter_items_chunked(lib, query, sort, chunk_size):
+    with lib.transaction() as tx:
+        min_id, max_id = tx.query("SELECT MIN(id), MAX(id) FROM items")[0]
+    if min_id is None:
+        return
+    for start in range(min_id, max_id + 1, chunk_size):
+        id_query = NumericQuery("id", f"{start}..{start + chunk_size - 1}")
+        yield from lib.items(AndQuery([query, id_query]), sort)
+
+
+# Returns the value stored for key in the plugin's SQLite file at path, or None
+def read_state(path, key):
+    connection = _connect_state(path)
+    try:
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def write_state(path, key, value):
+    connection = _connect_state(path)
+    try:
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+    finally:
+        connection.close()
+
+
+def _connect_state(path):
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    return connection
+
+
+# The names in the artists and albumartists fields of the items of the library, kept
+# in the plugin's SQLite file so they don't have to be read from the whole library on
+# each run. The rows are (item id, name), so an item's names can be replaced when
+# it changes.
+class LibraryArtistIndex:
+    def __init__(self, path):
+        self.connection = _connect_state(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS library_artists "
+            "(item_id INTEGER NOT NULL, name TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS library_artists_item_id "
+            "ON library_artists (item_id)"
+        )
+
+    def is_built(self):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'library_artists'"
+        ).fetchone()
+        return row is not None
+
+    def count(self):
+        return self.connection.execute(
+            "SELECT COUNT(DISTINCT name) FROM library_artists"
+        ).fetchone()[0]
+
+    # item_names yields (item id, names) for all the items of the library
+    def rebuild(self, item_names):
+        with self.connection:
+            self.connection.execute("DELETE FROM library_artists")
+            self.connection.executemany(
+                "INSERT INTO library_artists (item_id, name) VALUES (?, ?)",
+                ((item_id, name) for item_id, names in item_names for name in names),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) "
+                "VALUES ('library_artists', ?)",
+                (str(time.time()),),
+            )
+
+    # Replaces the names of item_ids with item_names, (item id, names) for those of
+    # them which are still in the library
+    def update(self, item_ids, item_names):
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM library_artists WHERE item_id = ?",
+                ((item_id,) for item_id in item_ids),
+            )
+            self.connection.executemany(
+                "INSERT INTO library_artists (item_id, name) VALUES (?, ?)",
+                ((item_id, name) for item_id, names in item_names for name in names),
+            )
+
+    # Returns the names which contain one of the separators or feat keywords, the
+    # ones that would be split if they were not single artists
+    def names(self, separators, feat_keywords):
+        conditions = ["instr(name, ?) > 0" for x in separators if x] + [
+            "instr(lower(name), ?) > 0" for x in feat_keywords if x
+        ]
+        if not conditions:
+            return []
+        values = [x for x in separators if x] + [x.lower() for x in feat_keywords if x]
+        rows = self.connection.execute(
+            "SELECT DISTINCT name FROM library_artists WHERE "
+            + " OR ".join(conditions)
+            + " ORDER BY name",
+            values,
+        )
+        return [row[0] for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+# Yields (item id, names) for the items of the library (or the ones of item_ids
+# that exist), where names are the distinct values of their artists and albumartists
+def iter_item_artist_names(lib, item_ids=None, chunk_size=500):
+    if item_ids is None:
+        with lib.transaction() as tx:
+            min_id, max_id = tx.query("SELECT MIN(id), MAX(id) FROM items")[0]
+        if min_id is None:
+            return
+        windows = (
+            ("id BETWEEN ? AND ?", [start, start + chunk_size - 1])
+            for start in range(min_id, max_id + 1, chunk_size)
+        )
+    else:
+        item_ids = list(item_ids)
+        windows = (
+            (f"id IN ({', '.join('?' * len(ids))})", ids)
+            for ids in batched(item_ids, chunk_size)
+        )
+    for where, subvals in windows:
+        with lib.transaction() as tx:
+            rows = tx.query(
+                f"SELECT id, artists, albumartists FROM items WHERE {where}", subvals
+            )
+        for item_id, artists, albumartists in rows:
+            names = []
+            for field, value in [("artists", artists), ("albumartists", albumartists)]:
+                for name in Item._type(field).from_sql(value) or []:
+                    name = name.strip()
+                    if name and name not in names:
+                        names.append(name)
+            yield item_id, names
+
+
+# A query for the items added, or read from / written to their file, since timestamp.
+# Beets only updates mtime when it reads or writes the file, so an edit that was not
+# written to the file (beet modify with write: no) is not picked up.
+def changed_since_query(timestamp):
+    return OrQuery(
+        [
+            NumericQuery("added", f"{timestamp}.."),
+            NumericQuery("mtime", f"{timestamp}.."),
+        ]
+    )
+
+
+# Bump this when a change to the parsing code changes get_artists results, so
+# ParseCache entries from older versions are dropped
+PARSER_VERSION = 3
+
+
+# Returns a hash of everything besides the item itself that get_artists results depend on
+# index_stamp is the SingleArtistIndex.source_stamp of the single_artists_file, if any
+def parse_config_fingerprint(
+    single_artists, separators, feat_keywords, index_stamp=None
+):
+    config_values = [
+        PARSER_VERSION,
+        list(single_artists),
+        list(separators),
+        list(feat_keywords),
+    ]
+    if index_stamp is not None:
+        config_values.append(list(index_stamp))
+    config_json = json.dumps(config_values)
+    return hashlib.sha1(config_json.encode("utf-8")).hexdigest()
+
+
+# An on-disk cache of get_artists results, stored in an SQLite file.
+# Entries are keyed by the artist, title and existing artists of an item. The whole
+# cache is dropped when the config fingerprint changes, and the entries used the
+# least recently (counted in runs) are evicted when there are more than max_size.
+# New entries and use marks are written in batches and on close().
+class ParseCache:
+    def __init__(self, path, config_fingerprint, max_size=1000000, batch_size=1000):
+        self.path = path
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.pending_puts = []
+        self.pending_uses = []
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS parse_cache (
+                key TEXT PRIMARY KEY, artists TEXT, run INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS parse_cache_run ON parse_cache (run);
+            """)
+        if self.get_meta("config_fingerprint") != config_fingerprint:
+            self.connection.execute("DELETE FROM parse_cache")
+            self.set_meta("config_fingerprint", config_fingerprint)
+        self.run = int(self.get_meta("run") or 0) + 1
+        self.set_meta("run", str(self.run))
+        self.connection.commit()
+
+    def get_meta(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    @staticmethod
+    def key(artist, title, artists):
+        return json.dumps([artist, title, list(artists or [])], ensure_ascii=False)
+
+    # Returns the cached list of artists, or None
+    def get(self, artist, title, artists=None):
+        key = self.key(artist, title, artists)
+        row = self.connection.execute(
+            "SELECT artists, run FROM parse_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if row[1] != self.run:
+            self.pending_uses.append((self.run, key))
+            if len(self.pending_uses) >= self.batch_size:
+                self.flush()
+        return json.loads(row[0])
+
+    def put(self, artist, title, artists, artists_result):
+        self.pending_puts.append(
+            (
+                self.key(artist, title, artists),
+                json.dumps(artists_result, ensure_ascii=False),
+                self.run,
+            )
+        )
+        if len(self.pending_puts) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO parse_cache (key, artists, run) VALUES (?, ?, ?)",
+                self.pending_puts,
+            )
+            self.connection.executemany(
+                "UPDATE parse_cache SET run = ? WHERE key = ?", self.pending_uses
+            )
+        self.pending_puts = []
+        self.pending_uses = []
+
+    def evict(self):
+        (size,) = self.connection.execute("SELECT COUNT(*) FROM parse_cache").fetchone()
+        if size > self.max_size:
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM parse_cache WHERE key IN "
+                    "(SELECT key FROM parse_cache ORDER BY run LIMIT ?)",
+                    (size - self.max_size,),
+                )
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.connection.close()
+
+
+# a,b are lists of strings (None is the same as an empty list)
 # return True if every string in a is in b and vice versa, False otherwise
-def lists_have_same_strings(a, b):
+# Strings are compared after normalize_string. The lists must have the same length,
+# but duplicates are not counted, so ["A", "A", "B"] and ["A", "B", "B"] are the same.
+# a_keys/b_keys are the normalized_keys() of a/b, if the caller already has them
+def lists_have_same_strings(a, b, a_keys=None, b_keys=None):
+    a = a or []
+    b = b or []
     if len(a) != len(b):
         return False
-    lower_a = [normalize_string(x) for x in a]
-    lower_b = [normalize_string(x) for x in b]
-    diff = [x for x in lower_a if x not in lower_b] + [
-        x for x in lower_b if x not in lower_a
-    ]
-    return not len(diff) > 0
+    if a_keys is None:
+        a_keys = normalized_keys(a)
+    if b_keys is None:
+        b_keys = normalized_keys(b)
+    return a_keys == b_keys
+
+
+# Returns the set of normalized strings that lists_have_same_strings compares
+def normalized_keys(strings):
+    return frozenset(normalize_string(x) for x in strings or [])
 
 
 # This function is mostly copied from a project called maloja by krateng
 # most of it is unnecessary, it's copied and pasted from my uses of it in
 # other projects where song artists/tracks strings are normalized and compared
-def normalize_string(string_in):
+# normalize_string is this function wrapped in an LRU cache, see set_normalize_cache_size
+def _normalize_string(string_in):
     new_string = string_in.lower()
     remove_symbols = ["'", "`", "’"]
     replace_with_space = [" - ", ": "]
     for r in replace_with_space:
         new_string = new_string.replace(r, " ")
+    if new_string.isascii():
+        # NFD decomposition and combining marks only concern non-ASCII characters
+        return new_string.replace("'", "").replace("`", "").replace("  ", " ")
     new_string = "".join(
         char
         for char in unicodedata.normalize("NFD", new_string.lower())
@@ -310,3 +2319,14 @@ def normalize_string(string_in):
     )
     # new_string = re.sub(r"  *", " ", new_string)
     return new_string
+
+
+normalize_string = functools.lru_cache(maxsize=4096)(_normalize_string)
+
+
+# Replaces the normalize_string cache with one holding maxsize strings (None for
+# unbounded, 0 to disable it). Hits and misses are in normalize_string.cache_info()
+def set_normalize_cache_size(maxsize):
+    global normalize_string
+    if normalize_string.cache_parameters()["maxsize"] != maxsize:
+        normalize_string = functools.lru_cache(maxsize=maxsize)(_normalize_string)
@@ -0,0 +1,282 @@
+# Benchmarks for the autoartists plugin on a synthetic, seeded corpus.
+#
+# python bench/bench_autoartists.py [--items N] [--whitelist-sizes 10,1000,100000]
+#     [--e2e-items N] [--seed S] [--repeat R] [--output bench_output.json]
+#
+# Runs micro-benchmarks of get_artists, get_artists_many, split_artists_string,
+# normalize_string and lists_have_same_strings for each whitelist size, then
+# beet autoartists -y against a temporary library of --e2e-items items, and writes
+# the results as JSON (to stdout without --output) so runs of different versions can
+# be compared.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beets  # noqa: E402
+from beets import config  # noqa: E402
+from beets.library import Item, Library  # noqa: E402
+from beetsplug import autoartists  # noqa: E402
+
+SEPARATORS = ["␟", ", ", " & ", " and ", " + ", " with ", "/", ";"]
+FEAT_KEYWORDS = ["feat.", "featuring", "with"]
+
+FIRST_NAMES = ["John", "Anna", "Björk", "Zoë", "José", "Søren", "Mário", "Ayumi"]
+FIRST_NAMES += ["Léa", "Nikolai", "Ольга", "Дмитрий", "美空", "陈", "Ana María"]
+LAST_NAMES = ["Smith", "Guðmundsdóttir", "Núñez", "Kovač", "Øvergaard", "O'Brien"]
+LAST_NAMES += ["Müller", "Иванова", "ひばり", "奕迅", "Dupré", "Smith-Jones"]
+BAND_WORDS = ["Blue", "Night", "Orchestra", "Brothers", "Sky", "Velvet", "Echo"]
+BAND_WORDS += ["Machine", "Sisters", "Fire", "Garden", "Collective", "Ensemble"]
+TITLE_WORDS = ["Love", "Road", "Summer", "Heart", "City", "Dream", "Rain", "Light"]
+
+
+# A person ("Zoë Kovač") or band ("The Velvet Machine 12") name
+def random_name(rng):
+    if rng.random() < 0.5:
+        return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    words = " ".join(rng.sample(BAND_WORDS, rng.randint(1, 3)))
+    return f"The {words} {rng.randint(1, 999)}"
+
+
+# Returns a whitelist of size names containing separators, like the ones users
+# add to single_artists ("Earth, Wind & Fire")
+def generate_whitelist(rng, size):
+    names = set()
+    while len(names) < size:
+        separator = rng.choice([", ", " & ", " and ", " + ", " with ", "/"])
+        names.add(f"{random_name(rng)}{separator}{random_name(rng)}")
+    return sorted(names)
+
+
+# Returns count (artist, title, artists) tuples with several artists, featured
+# artists in the artist and title, bracket variants, existing artists and names
+# from the whitelist
+def generate_corpus(rng, count, whitelist):
+    corpus = []
+    for _ in range(count):
+        names = [random_name(rng) for _ in range(rng.choice([1, 1, 1, 2, 2, 3]))]
+        if whitelist and rng.random() < 0.2:
+            names[rng.randrange(len(names))] = rng.choice(whitelist)
+        artist = names[0]
+        for name in names[1:]:
+            artist += rng.choice(SEPARATORS[1:]) + name
+        if rng.random() < 0.15:
+            artist += (
+                f" {rng.choice(['feat.', 'Feat', 'featuring'])} {random_name(rng)}"
+            )
+        title = " ".join(rng.sample(TITLE_WORDS, rng.randint(1, 3)))
+        if rng.random() < 0.3:
+            opening, closing = rng.choice(["()", "[]"])
+            keyword = rng.choice(FEAT_KEYWORDS + ["Feat."])
+            featured = random_name(rng)
+            if rng.random() < 0.3:
+                featured += f" & {random_name(rng)}"
+            title += f" {opening}{keyword} {featured}{closing}"
+        if rng.random() < 0.1:
+            title += rng.choice([" (Live)", " [Remastered 2011]", " - Radio Edit"])
+        artists = rng.choice([None, None, [], [names[0]], names])
+        corpus.append((artist, title, artists))
+    return corpus
+
+
+# Returns the best (lowest) of repeat runs of function() in seconds
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(name, params, operations, seconds):
+    return {
+        "name": name,
+        "params": params,
+        "operations": operations,
+        "seconds": seconds,
+        "us_per_operation": seconds / operations * 1e6 if operations else None,
+    }
+
+
+def run_micro(corpus, whitelist, repeat):
+    params = {"whitelist_size": len(whitelist), "items": len(corpus)}
+    results = []
+    start = time.perf_counter()
+    parser = autoartists.ArtistParser(whitelist, SEPARATORS, FEAT_KEYWORDS)
+    results.append(result("build_parser", params, 1, time.perf_counter() - start))
+
+    def get_artists():
+        for artist, title, artists in corpus:
+            parser.get_artists(artist, title, artists)
+
+    results.append(
+        result("get_artists", params, len(corpus), best_time(get_artists, repeat))
+    )
+    results.append(
+        result(
+            "get_artists_many",
+            params,
+            len(corpus),
+            best_time(lambda: parser.get_artists_many(corpus), repeat),
+        )
+    )
+
+    artist_strings = [artist for artist, title, artists in corpus]
+
+    def split_artists_string():
+        for artist in artist_strings:
+            autoartists.split_artists_string(
+                artist, parser.single_artist_matcher, parser.separator_splitter
+            )
+
+    results.append(
+        result(
+            "split_artists_string",
+            params,
+            len(artist_strings),
+            best_time(split_artists_string, repeat),
+        )
+    )
+
+    outputs = parser.get_artists_many(corpus)
+    names = [name for artists in outputs for name in artists]
+
+    def normalize_string_uncached():
+        for name in names:
+            autoartists._normalize_string(name)
+
+    def normalize_string():
+        autoartists.normalize_string.cache_clear()
+        for name in names:
+            autoartists.normalize_string(name)
+
+    results.append(
+        result(
+            "normalize_string_uncached",
+            params,
+            len(names),
+            best_time(normalize_string_uncached, repeat),
+        )
+    )
+    results.append(
+        result(
+            "normalize_string", params, len(names), best_time(normalize_string, repeat)
+        )
+    )
+
+    pairs = [
+        (artists or [], list(reversed(output)))
+        for (artist, title, artists), output in zip(corpus, outputs)
+    ]
+
+    def lists_have_same_strings():
+        for a, b in pairs:
+            autoartists.lists_have_same_strings(a, b)
+
+    results.append(
+        result(
+            "lists_have_same_strings",
+            params,
+            len(pairs),
+            best_time(lists_have_same_strings, repeat),
+        )
+    )
+    return results
+
+
+# Runs beet autoartists -y on a new library of the corpus in a temporary directory
+def run_end_to_end(corpus, whitelist):
+    params = {"whitelist_size": len(whitelist), "items": len(corpus)}
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config.clear()
+        config.read(user=False, defaults=True)
+        config["import"]["write"] = False
+        config["autoartists"]["single_artists"] = whitelist
+        # A new library prints its migrations
+        with contextlib.redirect_stdout(io.StringIO()):
+            lib = Library(os.path.join(temp_dir, "library.db"), temp_dir)
+        start = time.perf_counter()
+        with lib.transaction():
+            for i, (artist, title, artists) in enumerate(corpus):
+                lib.add(
+                    Item(
+                        artist=artist,
+                        title=title,
+                        artists=artists or [],
+                        path=os.path.join(temp_dir, f"{i}.mp3"),
+                    )
+                )
+        results.append(
+            result("library_add", params, len(corpus), time.perf_counter() - start)
+        )
+        plugin = autoartists.AutoArtistsPlugin()
+        command = plugin.commands()[0]
+        opts, args = command.parser.parse_args(["-y"])
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                plugin.exec_autoartists(lib, opts, args)
+            except SystemExit:
+                pass
+        results.append(
+            result("exec_autoartists", params, len(corpus), time.perf_counter() - start)
+        )
+        lib._close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--whitelist-sizes", default="10,1000,100000")
+    parser.add_argument("--e2e-items", type=int, default=5000)
+    parser.add_argument("--e2e-whitelist-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(x) for x in args.whitelist_sizes.split(",") if x]:
+        rng = random.Random(args.seed)
+        whitelist = generate_whitelist(rng, size)
+        corpus = generate_corpus(rng, args.items, whitelist)
+        results += run_micro(corpus, whitelist, args.repeat)
+    if args.e2e_items > 0:
+        rng = random.Random(args.seed)
+        whitelist = generate_whitelist(rng, args.e2e_whitelist_size)
+        corpus = generate_corpus(rng, args.e2e_items, whitelist)
+        results += run_end_to_end(corpus, whitelist)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "beets": beets.__version__,
+            "platform": platform.platform(),
+            "time": time.time(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json + "\n")
+    else:
+        print(report_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
+import json
+import os
+import pickle
+import re
+import tempfile
 import unittest
+from unittest import mock
 import pytest
 from beets import config
 from beets.test import _common
+from beets.library import Item, parse_query_parts
 from beets.test.helper import BeetsTestCase
 from beetsplug import autoartists
 
@@ -285,6 +292,777 @@ class AutoArtistsPluginTest(BeetsTestCase):
                 print(f"Failed on test result: {test_result}")
                 raise e
 
+    def test_single_artist_matcher(self):
+        matcher = autoartists.SingleArtistMatcher(
+            ["Earth, Wind & Fire", "Earth", "AC/DC", "Simon & Garfunkel"]
+        )
+        # leftmost-longest, case-insensitive, names spelled as in the config
+        assert matcher.find("earth, wind & fire with Simon & Garfunkel") == [
+            (0, 18, "Earth, Wind & Fire"),
+            (24, 41, "Simon & Garfunkel"),
+        ]
+        assert matcher.find("Earth and AC/DC") == [(0, 5, "Earth"), (10, 15, "AC/DC")]
+        assert matcher.find("Jim Croce") == []
+        assert autoartists.SingleArtistMatcher([]).find("AC/DC") == []
+        # the matched text is removed whatever its case
+        test_result = autoartists.split_artists_string(
+            "Jim Croce & ac/dc", matcher, separators=["␟", " & "]
+        )
+        assert test_result == ["Jim Croce", "AC/DC"]
+        # a large whitelist is matched the same way
+        artist_whitelist = [f"Band {i} & Friends" for i in range(20000)]
+        self._setup_config(single_artists=artist_whitelist + ["A and B"])
+        # the trie is only built when a string is parsed
+        assert "root" not in vars(self.plugin.parser.single_artist_matcher)
+        test_result = self.plugin.get_artists(
+            "Band 19999 & Friends feat. A and B", "Song Title"
+        )
+        assert test_result == ["Band 19999 & Friends", "A and B"]
+
+    def test_separator_splitter(self):
+        separators = ["␟", ", ", " & ", " and ", " + ", " with ", "/", ";"]
+        splitter = autoartists.get_separator_splitter(separators)
+        assert splitter is autoartists.get_separator_splitter(list(separators))
+        for artists_string in [
+            "A, B & C and D + E with F/G;H␟I",
+            "A,B & C",
+            ", A & ",
+            "A and B and C",
+            "Jim Croce",
+            "",
+        ]:
+            # same result as replacing every separator with the first one
+            replaced = artists_string
+            for separator in separators[1:]:
+                replaced = replaced.replace(separator, separators[0])
+            assert splitter.split(artists_string) == replaced.split(separators[0])
+        assert autoartists.SeparatorSplitter([]).split("A & B") == ["A & B"]
+
+    def test_feat_extractor(self):
+        extractor = autoartists.get_feat_extractor(["feat.", "featuring", "with"])
+        assert extractor.extract_artist("A (feat. B & C)") == ("A ", ["B & C"])
+        assert extractor.extract_artist("A Featuring B") == ("A", ["B"])
+        assert extractor.extract_artist("A feat. B (with C) (Live)") == (
+            "A",
+            ["B ", "C"],
+        )
+        assert extractor.extract_artist("A & B") == ("A & B", [])
+        assert extractor.extract_title("Song (feat. B) (with C)") == ["C"]
+        assert extractor.extract_title("Song (A Deal with God)") == []
+        assert extractor.extract_title("You Belong With Me") == []
+        # "with" is only a feat keyword in brackets, inline keywords keep their case
+        assert extractor.extract_artist("A FEAT. B") == ("A FEAT. B", [])
+        # only the title clause may leave out the dot, like before the regex rewrite
+        for artist in ["A feat B", "A Feat B", "A (feat B)"]:
+            assert extractor.extract_artist(artist) == (artist, [])
+        assert extractor.extract_title("Song (feat B)") == ["B"]
+        self._setup_config(single_artists=[])
+        for band in [
+            "Death With Dignity",
+            "The Band With No Name",
+            "Shakin' Stevens With Bonnie Tyler",
+        ]:
+            assert self.plugin.get_artists(band, "Song") == [band]
+        reference_parser = autoartists.ReferenceArtistParser(
+            [], self.plugin.separators, self.plugin.feat_keywords
+        )
+        for artist, title in [("A feat B", "Song"), ("A (feat B)", "Song (Feat C)")]:
+            assert self.plugin.get_artists(
+                artist, title
+            ) == reference_parser.get_artists(artist, title)
+        # extra keywords come from the config
+        self.config["autoartists"]["feat_keywords"] = ["feat.", "ft.", "x"]
+        self._setup_config(single_artists=[])
+        for test_result in [
+            self.plugin.get_artists("Artist A ft. Artist B", "Song Title"),
+            self.plugin.get_artists("Artist A x Artist B", "Song Title"),
+            self.plugin.get_artists("Artist A", "Song Title (ft Artist B)"),
+            self.plugin.get_artists("Artist A", "Song Title [x Artist B]"),
+        ]:
+            assert test_result == ["Artist A", "Artist B"]
+        self.config["autoartists"]["feat_keywords"] = ["feat.", "featuring", "with"]
+
+    def test_normalize_string(self):
+        for string_in in [
+            "Beyoncé",
+            "Sigur Rós",
+            "Guns N' Roses",
+            "Artist - Name: Live",
+            "Taylor’s Version…",
+            "AC/DC",
+            "",
+        ]:
+            assert autoartists.normalize_string(string_in) == (
+                autoartists._normalize_string(string_in)
+            )
+        assert autoartists.normalize_string("Guns N' Roses") == "guns n roses"
+        assert autoartists.normalize_string("Beyoncé") == "beyonce"
+        autoartists.set_normalize_cache_size(2)
+        autoartists.normalize_string("A")
+        autoartists.normalize_string("A")
+        autoartists.normalize_string("B")
+        autoartists.normalize_string("C")
+        cache_info = autoartists.normalize_string.cache_info()
+        assert (cache_info.hits, cache_info.misses, cache_info.currsize) == (1, 3, 2)
+        autoartists.set_normalize_cache_size(4096)
+
+    def test_lists_have_same_strings(self):
+        assert autoartists.lists_have_same_strings(["A", "Beyoncé"], ["beyonce", "a"])
+        assert not autoartists.lists_have_same_strings(["A", "B"], ["A", "C"])
+        assert not autoartists.lists_have_same_strings(["A"], ["A", "B"])
+        assert autoartists.lists_have_same_strings(None, [])
+        assert not autoartists.lists_have_same_strings(None, ["A"])
+        # same length and same strings, duplicates are not counted
+        assert autoartists.lists_have_same_strings(["A", "A", "B"], ["A", "B", "B"])
+        assert not autoartists.lists_have_same_strings(["A", "A"], ["A", "B"])
+        a_keys = autoartists.normalized_keys(["A", "B"])
+        assert autoartists.lists_have_same_strings(
+            ["A", "B"], ["b", "a"], a_keys=a_keys
+        )
+
+    def test_parse_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._check_parse_cache(os.path.join(temp_dir, "autoartists.db"))
+
+    def _check_parse_cache(self, path):
+        fingerprint = autoartists.parse_config_fingerprint(["AC/DC"], [", "], ["feat."])
+        cache = autoartists.ParseCache(path, fingerprint, max_size=2)
+        assert cache.get("A, B", "Song Title") is None
+        cache.put("A, B", "Song Title", None, ["A", "B"])
+        cache.close()
+        # the entry from the least recent run is evicted
+        cache = autoartists.ParseCache(path, fingerprint, max_size=2)
+        cache.put("C", "Song Title", ["C"], ["C"])
+        cache.put("D", "Song Title", None, ["D"])
+        cache.close()
+        cache = autoartists.ParseCache(path, fingerprint, max_size=2)
+        assert cache.get("A, B", "Song Title") is None
+        assert cache.get("C", "Song Title", ["C"]) == ["C"]
+        assert cache.get("D", "Song Title") == ["D"]
+        assert (cache.hits, cache.misses) == (2, 1)
+        cache.close()
+        # a different config drops the cached results
+        fingerprint = autoartists.parse_config_fingerprint([], [", "], ["feat."])
+        cache = autoartists.ParseCache(path, fingerprint)
+        assert cache.get("D", "Song Title") is None
+        cache.close()
+
+    def test_changed_since_query(self):
+        for title, added, mtime in [
+            ("Old", 100.0, 100.0),
+            ("Added", 300.0, 100.0),
+            ("Written", 100.0, 300.0),
+        ]:
+            item = Item(title=title, artist="A")
+            self.lib.add(item)
+            item.added = added
+            item.mtime = mtime
+            item.store()
+        query = autoartists.changed_since_query(200.0)
+        assert sorted(x["title"] for x in self.lib.items(query)) == ["Added", "Written"]
+
+    def _run_autoartists(self, *args, confirm="y"):
+        opts, args = self.plugin.commands()[0].parser.parse_args(list(args))
+        with mock.patch("builtins.input", return_value=confirm):
+            self.plugin.exec_autoartists(self.lib, opts, args)
+
+    def test_exec_autoartists(self):
+        self.config["import"]["write"] = False
+        self.config["autoartists"]["chunk_size"] = 2
+        self.config["autoartists"]["db_batch_size"] = 2
+        self._setup_config(single_artists=["Earth, Wind & Fire"])
+        for artist, title, artists in [
+            ("A & B", "Song Title", []),
+            ("C", "Song Title (feat. D)", ["C"]),
+            ("Earth, Wind & Fire", "September", ["Earth, Wind & Fire"]),
+            ("E", "Song Title", []),
+        ]:
+            self.lib.add(Item(artist=artist, title=title, artists=artists))
+        self._run_autoartists()
+        assert {x["artist"]: x["artists"] for x in self.lib.items()} == {
+            "A & B": ["A", "B"],
+            "C": ["C", "D"],
+            "Earth, Wind & Fire": ["Earth, Wind & Fire"],
+            "E": ["E"],
+        }
+        with pytest.raises(SystemExit):
+            self._run_autoartists()
+        self.lib.add(Item(artist="F & G", title="Song Title"))
+        opts, args = self.plugin.commands()[0].parser.parse_args(["-y"])
+        with mock.patch("builtins.input", side_effect=AssertionError):
+            self.plugin.exec_autoartists(self.lib, opts, args)
+        assert self.lib.get_item(5)["artists"] == ["F", "G"]
+
+    def test_write_workers(self):
+        self.config["import"]["write"] = True
+        self._setup_config(single_artists=[])
+        for i in range(5):
+            self.lib.add(
+                Item(artist=f"A{i} & B", title="Song Title", path=f"/x/{i}.mp3")
+            )
+        with mock.patch.object(autoartists, "print_") as print_:
+            self._run_autoartists("--write-workers", "2")
+        # the files don't exist, the failures are reported and the items still stored
+        assert mock.call("5 files could not be written:") in print_.call_args_list
+        assert all(x["artists"] == [x["artist"][:2], "B"] for x in self.lib.items())
+
+    def test_parse_jobs(self):
+        parser = autoartists.ArtistParser(
+            ["Earth, Wind & Fire"], [", ", " & "], ["feat."]
+        )
+        parser = pickle.loads(pickle.dumps(parser))
+        assert parser.get_artists("Earth, Wind & Fire feat. A & B", "September") == [
+            "Earth, Wind & Fire",
+            "A",
+            "B",
+        ]
+        self.config["import"]["write"] = False
+        self.config["autoartists"]["chunk_size"] = 3
+        self._setup_config(single_artists=[])
+        for i in range(10):
+            self.lib.add(Item(artist=f"A{i} & B", title=f"Song (feat. C{i})"))
+        self._run_autoartists("--jobs", "2")
+        for item in self.lib.items():
+            assert item["artists"] == [item["artist"][:2], "B", f"C{item['artist'][1]}"]
+
+    def test_get_artists_many(self):
+        self._setup_config(single_artists=["Earth, Wind & Fire"])
+        inputs = [
+            ("Earth, Wind & Fire feat. A", "September (with B & C)", None),
+            ("Earth, Wind & Fire feat. A", "Boogie Wonderland (with B & C)", ["D"]),
+            ("A & B", "Song Title (feat. Earth, Wind & Fire)", []),
+            ("A & B", "Song Title", ["A", "B"]),
+        ]
+        assert self.plugin.get_artists_many(inputs) == [
+            self.plugin.get_artists(*x) for x in inputs
+        ]
+
+    def test_plan_and_apply(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._check_plan_and_apply(os.path.join(temp_dir, "plan.jsonl"))
+
+    def _check_plan_and_apply(self, plan_path):
+        self.config["import"]["write"] = False
+        self._setup_config(single_artists=[])
+        for artist in ["A & B", "C & D", "E & F", "G"]:
+            self.lib.add(Item(artist=artist, title="Song Title", artists=[]))
+        self._run_autoartists("--plan", plan_path)
+        with open(plan_path, encoding="utf-8") as f:
+            records = [json.loads(x) for x in f]
+        assert [x["new"] for x in records] == [
+            ["A", "B"],
+            ["C", "D"],
+            ["E", "F"],
+            ["G"],
+        ]
+        assert all(x["artists"] == [] for x in self.lib.items())
+        # the item edited since the plan was made is skipped
+        edited = self.lib.get_item(records[1]["id"])
+        edited["artist"] = "C and D"
+        edited.store()
+        # resume after the first change
+        with open(f"{plan_path}.progress", "w", encoding="utf-8") as f:
+            f.write("1")
+        self._run_autoartists("--apply", plan_path)
+        assert {x["artist"]: x["artists"] for x in self.lib.items()} == {
+            "A & B": [],
+            "C and D": [],
+            "E & F": ["E", "F"],
+            "G": ["G"],
+        }
+        assert not os.path.exists(f"{plan_path}.progress")
+        # a new plan in the same file doesn't resume the progress of the old one
+        with open(f"{plan_path}.progress", "w", encoding="utf-8") as f:
+            f.write("2")
+        self._run_autoartists("--plan", plan_path)
+        assert not os.path.exists(f"{plan_path}.progress")
+        self._run_autoartists("--apply", plan_path)
+        assert {x["artist"]: x["artists"] for x in self.lib.items()} == {
+            "A & B": ["A", "B"],
+            "C and D": ["C", "D"],
+            "E & F": ["E", "F"],
+            "G": ["G"],
+        }
+
+    def test_select_item_rows(self):
+        for artist, artists in [("A & B", []), ("C & D", ["C", "D"]), ("A & E", [])]:
+            item = Item(artist=artist, title="Song Title", artists=artists)
+            item["myflex"] = "1"
+            self.lib.add(item)
+        query, sort = parse_query_parts(["artist:A"], Item)
+        rows = list(autoartists.select_item_rows(self.lib, query, 2))
+        assert [(x["artist"], x["artists"]) for x in rows] == [
+            ("A & B", []),
+            ("A & E", []),
+        ]
+        query, sort = parse_query_parts([], Item)
+        rows = autoartists.select_item_rows(self.lib, query, 2, empty_artists_only=True)
+        assert [x["artist"] for x in rows] == ["A & B", "A & E"]
+        # flexible attributes need Items
+        query, sort = parse_query_parts(["myflex:1"], Item)
+        assert autoartists.select_item_rows(self.lib, query, 2) is None
+        self.config["import"]["write"] = False
+        self._setup_config(single_artists=[])
+        self._run_autoartists("--no-overwrite", "myflex:1")
+        assert {x["artist"]: x["artists"] for x in self.lib.items()} == {
+            "A & B": ["A", "B"],
+            "C & D": ["C", "D"],
+            "A & E": ["A", "E"],
+        }
+        # the changes are listed from the selected fields
+        query, sort = parse_query_parts([], Item)
+        fields = autoartists.ITEM_ROW_FIELDS + autoartists.display_fields()
+        rows = list(autoartists.select_item_rows(self.lib, query, 2, fields=fields))
+        descriptions = [f"{self.lib.get_item(x['id'])}" for x in rows]
+        with mock.patch.object(self.lib, "get_item", side_effect=AssertionError):
+            assert [
+                autoartists.describe_song(self.lib, x) for x in rows
+            ] == descriptions
+        # a sort in the query orders the changes
+        for item in self.lib.items():
+            item["artists"] = []
+            item.store()
+        with mock.patch.object(autoartists, "print_") as print_:
+            self._run_autoartists("artist:A", "artist-")
+        printed = [x.args[0] for x in print_.call_args_list]
+        assert [x for x in printed if x.startswith("A & ")] == [
+            "A & E -  - Song Title: ",
+            "A & B -  - Song Title: ",
+        ]
+
+    def test_imported_writes_once(self):
+        self.config["import"]["write"] = True
+        self._setup_config(single_artists=[])
+        for apply, writes in [(True, 0), (False, 1)]:
+            item = Item(artist="A & B", title="Song Title", artists=[])
+            self.lib.add(item)
+            task = mock.Mock(apply=apply, choice_flag=None)
+            task.imported_items.return_value = [item]
+            session = mock.Mock(lib=self.lib)
+            with mock.patch.object(Item, "write") as write:
+                self.plugin.imported(session, task)
+            # the importer writes the files it applied metadata to after this stage
+            assert write.call_count == writes
+            assert self.lib.get_item(item.id)["artists"] == ["A", "B"]
+
+    def test_db_batches(self):
+        self.config["import"]["write"] = False
+        self.config["autoartists"]["db_batch_size"] = 2
+        self._setup_config(single_artists=[])
+        items = [Item(artist=f"A{i} & B", title="Song", artists=[]) for i in range(5)]
+        for item in items:
+            self.lib.add(item)
+        store = Item.store
+
+        # Item.store, interrupted after limit stores
+        def interrupted_store(limit):
+            stored = []
+
+            def interrupted(item, *args, **kwargs):
+                if len(stored) == limit:
+                    raise KeyboardInterrupt
+                stored.append(item.id)
+                store(item, *args, **kwargs)
+
+            return mock.patch.object(Item, "store", interrupted)
+
+        def stored_artists():
+            return [self.lib.get_item(x.id)["artists"] for x in items]
+
+        # the batches finished before the interruption are committed
+        with interrupted_store(4), pytest.raises(KeyboardInterrupt):
+            self._run_autoartists()
+        assert stored_artists() == [[f"A{i}", "B"] for i in range(4)] + [[]]
+        for item in self.lib.items():
+            item["artists"] = []
+            item.store()
+        for item in items:
+            item.load()
+        # and on import, with one transaction per batch
+        task = mock.Mock(apply=False, choice_flag=None)
+        task.imported_items.return_value = items
+        session = mock.Mock(lib=self.lib)
+        with interrupted_store(2), pytest.raises(KeyboardInterrupt):
+            self.plugin.imported(session, task)
+        assert stored_artists() == [["A0", "B"], ["A1", "B"], [], [], []]
+        for item in items:
+            item.load()
+        statements = []
+        self.lib._connection().set_trace_callback(statements.append)
+        try:
+            self.plugin.imported(session, task)
+        finally:
+            self.lib._connection().set_trace_callback(None)
+        assert statements.count("COMMIT") == 2
+        assert stored_artists() == [[f"A{i}", "B"] for i in range(5)]
+
+    def test_write_artists_only(self):
+        item = Item(path=b"/tmp/song.mp3", artist="A & B", artists=["A", "B"])
+        for file_artists, saved in [(["A", "B"], False), (["A & B"], True)]:
+            with mock.patch.object(autoartists, "MediaFile") as media_file:
+                media_file.return_value.artists = file_artists
+                with mock.patch.object(Item, "current_mtime", return_value=1):
+                    assert autoartists.write_song(item, artists_only=True) is None
+            mediafile = media_file.return_value
+            assert mediafile.save.called == saved
+            if saved:
+                mediafile.update.assert_called_once_with({"artists": ["A", "B"]})
+
+    def test_album_mode(self):
+        self.config["import"]["write"] = False
+        self.config["autoartists"]["chunk_size"] = 2
+        self._setup_config(single_artists=[])
+        albums = {}
+        for album_name, count in [("X", 3), ("Y", 1), ("Z", 2)]:
+            items = [
+                Item(artist=f"{album_name} & B", title=f"Song {i}", album=album_name)
+                for i in range(count)
+            ]
+            albums[album_name] = self.lib.add_album(items)
+        self.lib.add(Item(artist="Single & B", title="Song"))
+        with mock.patch.object(
+            self.plugin, "apply_changes", wraps=self.plugin.apply_changes
+        ) as apply_changes:
+            self._run_autoartists("-a", "album:X", ",", "album:Z")
+        # one batch per album, and the item without an album is not in the query
+        assert [len(x.args[1]) for x in apply_changes.call_args_list] == [3, 2]
+        for item in self.lib.items():
+            expected = [] if item["album"] in ("Y", "") else [item["album"], "B"]
+            assert item["artists"] == expected
+
+    def test_single_artist_index(self):
+        names = ["Earth, Wind & Fire", "AC/DC", "Simon & Garfunkel", "Simon", "Ω & Σ"]
+        strings = [
+            "earth, wind & fire feat. Simon & Garfunkel",
+            "Simon & X and ac/dc",
+            "ω & σ / Simon",
+            "Nobody",
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "artists.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(names + ["", "simon"]) + "\n")
+            trie = autoartists.SingleArtistMatcher(names)
+            matcher = autoartists.get_single_artist_matcher([], path)
+            assert len(matcher) == 5 and os.path.exists(f"{path}.idx")
+            for string in strings:
+                assert matcher.find(string) == trie.find(string)
+            # config names win ties, longer index names win over them
+            matcher = autoartists.get_single_artist_matcher(["SIMON", "AC"], path)
+            assert matcher.find("simon & x, ac/dc") == [
+                (0, 5, "SIMON"),
+                (11, 16, "AC/DC"),
+            ]
+            parser = autoartists.ArtistParser([], [", ", " & "], ["feat."], path)
+            parser = pickle.loads(pickle.dumps(parser))
+            assert parser.get_artists("Simon & Garfunkel, A", "Song") == [
+                "Simon & Garfunkel",
+                "A",
+            ]
+            # the index is rebuilt when the source changes
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("A & B\n")
+            os.utime(path, ns=(0, 0))
+            matcher = autoartists.get_single_artist_matcher([], path)
+            assert len(matcher) == 6
+            assert matcher.find("x / a & b") == [(4, 9, "A & B")]
+            # an unwritable source directory puts the index in the config directory
+            os.remove(f"{path}.idx")
+            os.utime(path, ns=(1, 1))
+            replace = os.replace
+
+            def replace_outside(source, destination):
+                if os.path.dirname(destination) == temp_dir:
+                    raise PermissionError(13, "Permission denied")
+                replace(source, destination)
+
+            with mock.patch.object(autoartists.os, "replace", replace_outside):
+                matcher = autoartists.get_single_artist_matcher([], path)
+                index_path = autoartists.SingleArtistIndex.fallback_index_path(path)
+                assert len(matcher) == 6 and os.path.exists(index_path)
+                assert os.listdir(temp_dir) == ["artists.txt"]
+                # and without any writable place, only the config names are used
+                os.utime(path, ns=(2, 2))
+                with mock.patch.object(
+                    autoartists.SingleArtistIndex,
+                    "fallback_index_path",
+                    return_value=os.path.join(temp_dir, "other.idx"),
+                ):
+                    matcher = autoartists.get_single_artist_matcher(["A & B"], path)
+                assert len(matcher) == 1
+                assert matcher.find("x / a & b") == [(4, 9, "A & B")]
+            # nor with a file that isn't UTF-8
+            with open(path, "w", encoding="latin-1") as f:
+                f.write("Björk & Guðmundur\n")
+            matcher = autoartists.get_single_artist_matcher(["A & B"], path)
+            assert len(matcher) == 1
+            reference_parser = autoartists.ReferenceArtistParser(
+                ["A & B"], [" & "], ["feat."], path
+            )
+            assert reference_parser.single_artist_list == ["A & B"]
+            self.config["autoartists"]["single_artists_file"] = path
+            self._setup_config(single_artists=["A & B"])
+            assert self.plugin.parser.get_artists("A & B & C", "Song") == ["A & B", "C"]
+
+    def test_library_artists(self):
+        self.config["import"]["write"] = False
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.config["autoartists"]["cache_path"] = os.path.join(temp_dir, "s.db")
+            self.config["autoartists"]["library_artists"] = True
+            self._setup_config(single_artists=[])
+            self.lib.add(
+                Item(artist="Simon & Garfunkel", artists=["Simon & Garfunkel"])
+            )
+            self.lib.add(Item(artist="A", artists=["A"], albumartists=["C and D"]))
+            self.lib.add(Item(artist="Simon & Garfunkel feat. X & C and D"))
+            self._run_autoartists("id:3")
+            # names which are single values in the library are single artists
+            assert self.lib.get_item(3)["artists"] == [
+                "Simon & Garfunkel",
+                "C and D",
+                "X",
+            ]
+            # changes and removals are indexed when the command exits
+            changed = self.lib.get_item(1)
+            changed["artists"] = ["E / F"]
+            changed.store()
+            self.plugin.library_changed(self.lib, changed)
+            removed = self.lib.get_item(2)
+            removed.remove()
+            self.plugin.library_item_removed(removed)
+            self.plugin.flush_library_artists(self.lib)
+            index = autoartists.LibraryArtistIndex(self.plugin.state_path(self.lib))
+            try:
+                assert index.names([" & ", " / "], ["feat."]) == [
+                    "E / F",
+                    "Simon & Garfunkel",
+                ]
+            finally:
+                index.close()
+            with mock.patch.object(autoartists, "print_") as print_:
+                self._run_autoartists("--rebuild-index")
+            # E / F, and the artists of item 3
+            print_.assert_called_once_with("Indexed 4 artist names in the library")
+
+    def test_auto_update(self):
+        self.config["import"]["write"] = False
+        self._setup_config(single_artists=[])
+        items = [
+            Item(artist="A", title="Song", artists=["A"]),
+            Item(artist="B", title="Song", artists=["B"]),
+            Item(artist="Simon & Garfunkel", title="Song"),
+        ]
+        for item in items:
+            self.lib.add(item)
+        # without auto_update, no source is recorded
+        self._run_autoartists()
+        assert [autoartists.SOURCE_FIELD in x for x in self.lib.items()] == [False] * 3
+        self.config["autoartists"]["auto_update"] = True
+        self._setup_config(single_artists=[])
+
+        def update(*changed_items):
+            for item in changed_items:
+                item.store()
+                self.plugin.item_changed(self.lib, item)
+            with mock.patch.object(
+                self.plugin, "apply_changes", wraps=self.plugin.apply_changes
+            ) as apply_changes:
+                self.plugin.update_changed_items(self.lib)
+            assert self.plugin.changed_item_ids == set()
+            for item in items:
+                item.load()
+            return [len(x.args[1]) for x in apply_changes.call_args_list]
+
+        # items without a source are parsed again
+        items[1]["artist"] = "B & C"
+        assert update(items[1]) == [1]
+        assert items[1]["artists"] == ["B", "C"]
+        # a run records the sources of the unchanged items too
+        with pytest.raises(SystemExit):
+            self._run_autoartists()
+        assert len({x.get(autoartists.SOURCE_FIELD) for x in self.lib.items()}) == 3
+        items[0]["artist"] = "A & C"
+        assert update(items[0]) == [1]
+        assert items[0]["artists"] == ["A", "C"]
+        # editing the artists or another field doesn't undo the edit, nor store the
+        # items again
+        items[2]["artists"] = ["Simon & Garfunkel"]
+        assert update(items[2]) == []
+        for item in items:
+            item["genre"] = "Folk"
+            item.store()
+            self.plugin.item_changed(self.lib, item)
+        with mock.patch.object(Item, "store", side_effect=AssertionError):
+            assert update() == []
+        assert items[2]["artists"] == ["Simon & Garfunkel"]
+
+    def test_stats(self):
+        self.config["import"]["write"] = False
+        self._setup_config(single_artists=["Earth, Wind & Fire"])
+        self.lib.add(Item(artist="Earth, Wind & Fire & A", title="Song (feat. B)"))
+        store = Item.store
+        with mock.patch.object(autoartists, "print_") as print_:
+            self._run_autoartists("--stats")
+        lines = [x.args[0] for x in print_.call_args_list]
+        stats = lines[lines.index("Stats:") + 1 :]
+        stages = {x.split(":")[0]: x for x in stats}
+        assert re.fullmatch(r"store: \d+\.\d{3}s, 1 calls", stages["store"])
+        assert {"get_artists", "whitelist matching", "db loading", "total"} <= set(
+            stages
+        )
+        # the timed wrappers are removed after the run
+        assert Item.store is store
+        assert "find" not in vars(self.plugin.parser.single_artist_matcher)
+        assert autoartists.normalize_string.__name__ == "_normalize_string"
+
+    def test_reference_parser(self):
+        config = (
+            ["Earth, Wind & Fire", "Simon & Garfunkel"],
+            [", ", " & ", " with "],
+            ["feat.", "featuring", "with"],
+        )
+        parser = autoartists.ArtistParser(*config)
+        reference_parser = autoartists.ReferenceArtistParser(*config)
+        inputs = [
+            ("A & B", "Song", None),
+            ("Earth, Wind & Fire feat. C", "Song (with D)", None),
+            ("A feat. B", "Song [feat. C & D]", []),
+            ("Simon & Garfunkel, Paul", "Song", ["Simon & Garfunkel"]),
+            ("X", "Song (Featuring Y)", ["Z"]),
+        ]
+        assert reference_parser.get_artists_many(inputs) == parser.get_artists_many(
+            inputs
+        )
+        # the reference keeps the old results, here a single artist in another case
+        # which was only removed from the string when it matched exactly
+        assert reference_parser.get_artists("earth, wind & fire & X", "Song") == [
+            "Earth, Wind & Fire",
+            "earth",
+            "wind",
+            "fire",
+            "X",
+        ]
+        assert parser.get_artists("earth, wind & fire & X", "Song") == [
+            "Earth, Wind & Fire",
+            "X",
+        ]
+
+    def test_verify_engine(self):
+        self._setup_config(single_artists=["Earth, Wind & Fire"])
+        for artist, title in [
+            ("A & B", "Song"),
+            ("Earth, Wind & Fire feat. C", "Song (with D)"),
+            ("E", "Song"),
+        ]:
+            self.lib.add(Item(artist=artist, title=title))
+        with mock.patch.object(autoartists, "print_") as print_:
+            self._run_autoartists("--verify-engine", "-j", "1")
+        print_.assert_called_once_with("Verified 3 items, 0 differ from the reference")
+        self.lib.add(Item(artist="earth, wind & fire & F", title="Song"))
+        with mock.patch.object(autoartists, "print_") as print_:
+            with pytest.raises(SystemExit):
+                self._run_autoartists("--verify-engine", "-j", "1")
+        assert print_.call_args_list[-1] == mock.call(
+            "Verified 4 items, 1 differ from the reference"
+        )
+        self.lib.get_item(4).remove()
+        # shadow mode counts the differences
+        self.config["import"]["write"] = False
+        self.config["autoartists"]["shadow_fraction"] = 1.0
+        self._setup_config(single_artists=["Earth, Wind & Fire"])
+        with mock.patch.object(
+            self.plugin.parser,
+            "get_artists_many",
+            side_effect=lambda x: [["X"]] * len(x),
+        ):
+            self._run_autoartists()
+            assert (self.plugin.shadow_checked, self.plugin.shadow_diverged) == (3, 3)
+            # including the items parsed on import and by auto_update
+            self.plugin.get_artists_many([("A & B", "Song", None)])
+        assert (self.plugin.shadow_checked, self.plugin.shadow_diverged) == (4, 4)
+
+    def test_shard_and_merge(self):
+        self.config["import"]["write"] = True
+        self._setup_config(single_artists=[])
+        for i in range(5):
+            self.lib.add(Item(artist=f"A{i} & B", title="Song", path=f"/x/{i}.mp3"))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = [os.path.join(temp_dir, f"shard{k}.jsonl") for k in (1, 2)]
+            # the first shard writes the files, the second leaves that to --merge
+            with mock.patch.object(Item, "write") as write:
+                self._run_autoartists(
+                    "--shard", "1/2", "--plan", paths[0], "--write-files"
+                )
+            assert write.call_count == 2
+            self._run_autoartists("--shard", "2/2", "--plan", paths[1])
+            for k, path in enumerate(paths):
+                with open(path, encoding="utf-8") as f:
+                    records = [json.loads(line) for line in f]
+                assert [x["id"] % 2 for x in records] == [k] * len(records)
+                assert all(("mtime" in x) == (k == 0) for x in records)
+            assert all(x["artists"] == [] for x in self.lib.items())
+            with mock.patch.object(Item, "write") as write:
+                self._run_autoartists("--merge", *paths)
+            assert write.call_count == 3
+        assert all(x["artists"] == [x["artist"][:2], "B"] for x in self.lib.items())
+        with pytest.raises(SystemExit) as exit_info:
+            self._run_autoartists("--merge")
+        assert exit_info.value.code == 1
+
+    def test_since_last_run(self):
+        self.config["import"]["write"] = False
+        self._setup_config(single_artists=[])
+
+        def add_item(artist, added):
+            item = Item(artist=artist, title="Song")
+            self.lib.add(item)
+            item.added = item.mtime = added
+            item.store()
+
+        def run(now, confirm="y"):
+            with mock.patch.object(autoartists, "print_") as print_:
+                with mock.patch.object(autoartists.time, "time", return_value=now):
+                    try:
+                        self._run_autoartists("--since-last-run", confirm=confirm)
+                    except SystemExit:
+                        pass
+            return [x.args[0] for x in print_.call_args_list]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.config["autoartists"]["cache_path"] = os.path.join(temp_dir, "s.db")
+            add_item("A & B", 100.0)
+            lines = run(200.0)
+            assert "No previous run with this query, processing all items" in lines
+            assert "1 found in query, 0 had no changes" in lines
+            # only the item added since the last run is processed
+            add_item("C & D", 300.0)
+            assert "1 found in query, 0 had no changes" in run(400.0)
+            assert self.lib.get_item(2)["artists"] == ["C", "D"]
+            # a canceled run doesn't count as the last run
+            add_item("E & F", 500.0)
+            assert "canceled" in run(600.0, confirm="n")
+            assert "1 found in query, 0 had no changes" in run(700.0)
+            assert self.lib.get_item(3)["artists"] == ["E", "F"]
+            assert "No results found" in run(800.0)
+            # the last run is kept per query
+            assert autoartists.read_state(
+                self.plugin.state_path(self.lib), "last_run "
+            ) == str(800.0)
+            # a plan counts as a run, its changes are applied with --apply
+            add_item("G & H", 900.0)
+            plan_path = os.path.join(temp_dir, "plan.jsonl")
+            with mock.patch.object(autoartists, "print_") as print_:
+                with mock.patch.object(autoartists.time, "time", return_value=1000.0):
+                    self._run_autoartists("--since-last-run", "--plan", plan_path)
+            print_.assert_called_with(
+                f"1 found in query, 1 changes written to {plan_path}"
+            )
+            self._run_autoartists("--apply", plan_path)
+            assert self.lib.get_item(4)["artists"] == ["G", "H"]
+            assert autoartists.read_state(
+                self.plugin.state_path(self.lib), "last_run "
+            ) == str(1000.0)
+
 
 test = AutoArtistsPluginTest()
 test.test_whitelist()